@@ -0,0 +1,186 @@
+import socket
+import time
+
+from collections import deque
+
+from ryu.lib import hub
+from ryu.lib.packet import arp, ethernet, packet
+from ryu.ofproto import ether
+
+# Probes per second each switch is allowed to send
+PROBE_RATE = 100
+# Seconds to wait for an answer before probing again, and number of attempts per IP
+PROBE_INTERVAL = 1.0
+PROBE_RETRIES = 3
+
+# Offset of the target IP in an Ethernet/ARP frame
+ARP_TARGET_IP_OFFSET = 38
+
+TICK = 0.1
+
+class DiscoveryRequest(object):
+    """ Completes once every IP of the request was found or given up on """
+    def __init__(self, ips):
+        self.ips = list(ips)
+        self.pending = set(self.ips)
+        self.results = {}
+
+        self._event = hub.Event()
+        if not self.pending:
+            self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+        return self.done()
+
+    def resolve(self, ip, mac):
+        if ip in self.pending:
+            self.pending.discard(ip)
+            self.results[ip] = mac
+
+            if not self.pending:
+                self._event.set()
+
+    def to_dict(self):
+        return { ip: self.results.get(ip) for ip in self.ips }
+
+class Probe(object):
+    __slots__ = ('attempts', 'sent', 'queued', 'requests')
+
+    def __init__(self):
+        self.attempts = 0
+        self.sent = None
+        self.queued = False
+        self.requests = []
+
+class HostDiscovery(object):
+    """ ARP probes for batches of IPs, sent from a pre-serialized template on the edge
+        ports of the switches with a per switch rate limit. Probes for the same IP are
+        only sent once however many requests are waiting for it """
+    def __init__(self, routing, src_mac, rate=PROBE_RATE, interval=PROBE_INTERVAL, retries=PROBE_RETRIES):
+        self.routing = routing
+        self.rate = rate
+        self.interval = interval
+        self.retries = retries
+
+        e = ethernet.ethernet(
+            dst='ff:ff:ff:ff:ff:ff',
+            src=src_mac,
+            ethertype=ether.ETH_TYPE_ARP
+        )
+
+        a = arp.arp(
+            src_ip='0.0.0.0',
+            src_mac=src_mac,
+            dst_ip='0.0.0.0',
+            dst_mac='ff:ff:ff:ff:ff:ff'
+        )
+
+        p = packet.Packet()
+        p.add_protocol(e)
+        p.add_protocol(a)
+        p.serialize()
+        self.template = bytes(p.data)
+
+        self.queue = deque()
+        self.outstanding = {}
+        # dpid -> [tokens, last refill]
+        self.buckets = {}
+
+        self.thread = hub.spawn(self._loop)
+
+    def discover(self, ips):
+        request = DiscoveryRequest(ips)
+
+        for ip in request.ips:
+            mac = self.routing.ip_to_mac.get(ip)
+            if mac:
+                request.resolve(ip, mac)
+                continue
+
+            probe = self.outstanding.get(ip)
+            if probe is None:
+                probe = self.outstanding[ip] = Probe()
+
+            probe.requests.append(request)
+            if not probe.queued and probe.sent is None:
+                probe.queued = True
+                self.queue.append(ip)
+
+        return request
+
+    def resolved(self, ip, mac):
+        probe = self.outstanding.pop(ip, None)
+        if probe:
+            for request in probe.requests:
+                request.resolve(ip, mac)
+
+    def probe_data(self, ip):
+        return self.template[:ARP_TARGET_IP_OFFSET] + socket.inet_aton(ip) + self.template[ARP_TARGET_IP_OFFSET+4:]
+
+    def refill(self, dpid, now):
+        bucket = self.buckets.setdefault(dpid, [self.rate, now])
+        bucket[0] = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+
+        return bucket
+
+    def _loop(self):
+        while True:
+            self._tick(time.time())
+            hub.sleep(TICK)
+
+    def _tick(self, now):
+        # Probe again (or give up on) the IPs that didn't answer in time
+        for ip, probe in list(self.outstanding.items()):
+            if probe.queued or probe.sent is None or now - probe.sent < self.interval:
+                continue
+
+            if probe.attempts >= self.retries:
+                del self.outstanding[ip]
+                for request in probe.requests:
+                    request.resolve(ip, None)
+            else:
+                probe.queued = True
+                self.queue.append(ip)
+
+        if not self.queue:
+            return
+
+        edges = self.routing.edge_switches()
+        if not edges:
+            return
+
+        buckets = [self.refill(datapath.id, now) for datapath, _ in edges]
+        while self.queue:
+            # A probe goes out of every edge switch, wait until they all can send
+            if any(bucket[0] < 1 for bucket in buckets):
+                break
+
+            ip = self.queue.popleft()
+            probe = self.outstanding.get(ip)
+            if probe is None:
+                continue
+
+            for bucket in buckets:
+                bucket[0] -= 1
+
+            data = self.probe_data(ip)
+            for datapath, ports in edges:
+                ofproto = datapath.ofproto
+                parser = datapath.ofproto_parser
+                out = parser.OFPPacketOut(
+                    datapath=datapath,
+                    buffer_id=ofproto.OFP_NO_BUFFER,
+                    in_port=ofproto.OFPP_CONTROLLER,
+                    actions=[parser.OFPActionOutput(port) for port in ports],
+                    data=data
+                )
+                datapath.send_msg(out)
+
+            probe.queued = False
+            probe.sent = now
+            probe.attempts += 1
@@ -0,0 +1,99 @@
+import numpy as np
+
+# Samples kept per pair and weight of the last sample in the moving average
+HISTORY_SIZE = 64
+EWMA_ALPHA = 0.2
+
+class RateHistory(object):
+    """ Timestamped traffic rates of the pairs in shared 2D ring buffers, one row per
+        pair. The EWMA and the peak over the window are kept up to date on every sample,
+        rows of forgotten pairs are reused """
+    def __init__(self, size=HISTORY_SIZE, alpha=EWMA_ALPHA, capacity=64):
+        self.size = size
+        self.alpha = alpha
+
+        self.times = np.zeros((capacity, size))
+        self.rates = np.zeros((capacity, size))
+        self.heads = np.zeros(capacity, dtype=np.int64)
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.ewma = np.zeros(capacity)
+        self.peak = np.zeros(capacity)
+
+        # key -> row
+        self.rows = {}
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def grow(self):
+        capacity = len(self.heads)
+        for name in ('times', 'rates', 'heads', 'counts', 'ewma', 'peak'):
+            array = getattr(self, name)
+            grown = np.zeros((capacity * 2,) + array.shape[1:], dtype=array.dtype)
+            grown[:capacity] = array
+            setattr(self, name, grown)
+
+        self.free.extend(range(capacity * 2 - 1, capacity - 1, -1))
+
+    def add(self, key, timestamp, rate):
+        row = self.rows.get(key)
+        if row is None:
+            if not self.free:
+                self.grow()
+            row = self.rows[key] = self.free.pop()
+
+        i = self.heads[row]
+        count = self.counts[row]
+        evicted = self.rates[row, i] if count == self.size else None
+
+        self.times[row, i] = timestamp
+        self.rates[row, i] = rate
+        self.heads[row] = (i + 1) % self.size
+        self.counts[row] = min(count + 1, self.size)
+
+        self.ewma[row] = rate if count == 0 else self.alpha * rate + (1 - self.alpha) * self.ewma[row]
+
+        # Only look at the whole window when the peak falls out of it
+        if count == 0 or rate >= self.peak[row]:
+            self.peak[row] = rate
+        elif evicted is not None and evicted >= self.peak[row]:
+            self.peak[row] = self.rates[row].max()
+
+    def remove(self, key):
+        row = self.rows.pop(key, None)
+        if row is not None:
+            self.heads[row] = 0
+            self.counts[row] = 0
+            self.free.append(row)
+
+    def expire(self, before):
+        """ Forget the pairs without a sample since before """
+        if not self.rows:
+            return
+
+        keys = list(self.rows)
+        rows = np.fromiter((self.rows[k] for k in keys), dtype=np.int64, count=len(keys))
+        last = self.times[rows, (self.heads[rows] - 1) % self.size]
+        for k in np.nonzero(last < before)[0]:
+            self.remove(keys[k])
+
+    def summary(self, key):
+        row = self.rows[key]
+        last = (self.heads[row] - 1) % self.size
+        return {
+            'rate':    float(self.rates[row, last]),
+            'ewma':    float(self.ewma[row]),
+            'peak':    float(self.peak[row]),
+            'samples': int(self.counts[row])
+        }
+
+    def samples(self, key):
+        """ (timestamp, rate) of the pair, oldest first """
+        row = self.rows[key]
+        count = self.counts[row]
+        order = (np.arange(self.heads[row] - count, self.heads[row])) % self.size
+        return list(zip(self.times[row, order].tolist(), self.rates[row, order].tolist()))
@@ -0,0 +1,112 @@
+import bisect
+import time
+
+from functools import wraps
+
+# Upper bounds in seconds of the latency histograms
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+class Metric(object):
+    """ Values per tuple of label values, rendered in the Prometheus text format """
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def label_string(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ''
+
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        for values, value in sorted(self.values.items()):
+            lines.append('{}{} {}'.format(self.name, self.label_string(values), repr(float(value))))
+
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *values, **kwargs):
+        self.values[values] = self.values.get(values, 0) + kwargs.get('amount', 1)
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *values):
+        self.values[values] = value
+
+class Histogram(Metric):
+    """ Cumulative bucket counts are only computed when rendering, observing is a bisect
+        and two additions """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *values):
+        # [count per bucket plus +Inf, sum]
+        histogram = self.values.get(values)
+        if histogram is None:
+            histogram = self.values[values] = [[0] * (len(self.buckets) + 1), 0.0]
+
+        histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+        histogram[1] += value
+
+    def time(self, *values):
+        """ Decorator observing the duration of the calls """
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.observe(time.time() - start, *values)
+            return wrapper
+        return decorator
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        for values, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, self.label_string(values, [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, self.label_string(values), repr(total)))
+            lines.append('{}_count{} {}'.format(self.name, self.label_string(values), cumulative))
+
+        return lines
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
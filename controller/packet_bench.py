@@ -0,0 +1,63 @@
+#!/usr/bin/python
+
+""" Time the classification of packet-ins, the full ryu parse the handler used to do against
+    classify_packet and parse_arp reading the raw data in place. Prints the packets per
+    second of each for ARP, LLDP and IPv4 frames """
+
+import argparse
+import array
+import socket
+import struct
+import time
+
+from ryu.lib.packet import arp, ethernet, ipv4, lldp, packet
+from ryu.sdnmgmt.routing import classify_packet, parse_arp
+
+SRC_MAC = '\x02\x00\x00\x00\x00\x01'
+DST_MAC = '\x02\x00\x00\x00\x00\x02'
+
+def arp_frame():
+    return struct.pack('!6s6sH', '\xff' * 6, SRC_MAC, 0x0806) + \
+        struct.pack('!HHBBH6s4s6s4s', 1, 0x0800, 6, 4, 1, SRC_MAC, socket.inet_aton('10.0.0.1'), '\x00' * 6, socket.inet_aton('10.0.0.2'))
+
+def lldp_frame():
+    # Chassis ID, port ID, TTL and end TLVs
+    tlvs = struct.pack('!HB6s', (1 << 9) | 7, 4, SRC_MAC) + struct.pack('!HB4s', (2 << 9) | 5, 2, '\x00\x00\x00\x01') + \
+        struct.pack('!HH', (3 << 9) | 2, 120) + struct.pack('!H', 0)
+    return struct.pack('!6s6sH', '\x01\x80\xc2\x00\x00\x0e', SRC_MAC, 0x88cc) + tlvs
+
+def ipv4_frame():
+    header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + 8, 0, 0, 64, 17, 0, socket.inet_aton('10.0.0.1'), socket.inet_aton('10.0.0.2'))
+    return struct.pack('!6s6sH', DST_MAC, SRC_MAC, 0x0800) + header + '\x00' * 8
+
+def ryu_parse(data):
+    """ What the handler did before """
+    pkt = packet.Packet(array.array('B', data))
+    if pkt.get_protocol(lldp.lldp):
+        return None
+
+    return pkt.get_protocol(ethernet.ethernet), pkt.get_protocol(arp.arp), pkt.get_protocol(ipv4.ipv4)
+
+def raw_parse(data):
+    ethertype, offset = classify_packet(data)
+    if ethertype == 0x0806:
+        return parse_arp(data, offset)
+
+    return ethertype
+
+def rate(f, data, count):
+    start = time.time()
+    for _ in xrange(count):
+        f(data)
+
+    return count / (time.time() - start)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=100000, help='packets per measurement')
+    args = parser.parse_args()
+
+    for name, data in (('arp', arp_frame()), ('lldp', lldp_frame()), ('ipv4', ipv4_frame())):
+        before = rate(ryu_parse, data, args.count)
+        after = rate(raw_parse, data, args.count)
+        print '{:5} ryu {:10.0f} pkt/s  raw {:10.0f} pkt/s  x{:.1f}'.format(name, before, after, after / before)
@@ -2,27 +2,114 @@ import logging
 
 from ryu.base import app_manager
 from ryu.controller import ofp_event
+from ryu.controller.event import EventBase
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3, ether
-from ryu.lib.packet import arp, ethernet, ipv4, packet, lldp
+from ryu.lib.packet import arp, ethernet, packet
 from ryu.topology import event
 from ryu.topology.switches import Link, Port
 from ryu.lib import mac
+from ryu.lib import hub
+from ryu.sdnmgmt.topology import CompactTopology
+from ryu.sdnmgmt.discovery import HostDiscovery
+from ryu.sdnmgmt.metrics import REGISTRY
 
+from collections import namedtuple, deque, OrderedDict
 import networkx as nx
-import array
+import itertools
+import json
+import os
+import socket
+import struct
+import time
+import zlib
 
 LOG = logging.getLogger(__name__)
 
+PACKET_INS = REGISTRY.counter('sdnscore_packet_ins_total', 'Packet-ins received by type', ('type',))
+PACKET_IN_SECONDS = REGISTRY.histogram('sdnscore_packet_in_seconds', 'Time spent handling a packet-in')
+PATH_SECONDS = REGISTRY.histogram('sdnscore_path_compute_seconds', 'Time spent computing a path missing from the cache')
+FLOW_MODS = REGISTRY.counter('sdnscore_flow_mods_total', 'FlowMods sent by command', ('command',))
+
 CONTROLLER_MAC = '02:02:02:02:02:02'
 
+# Flow priorities, the ARP redirection has to win over the forwarding rules and
+# IPv4 without a forwarding rule is sent to the controller
+ARP_PRIORITY = 3
+PAIR_PRIORITY = 2
+TREE_PRIORITY = 1
+MISS_PRIORITY = 0
+
+# Bytes of a packet without a rule sent to the controller, the rest stays buffered in the switch
+MISS_SEND_LEN = 128
+
+HOST_TYPES = ('hypervisor', 'vm')
+
+# Forwarding modes, a pair of rules per (src, dst) on every switch of the path or
+# one rule per destination on every switch with the pair rules only at the edge
+FORWARDING_PAIR = 'pair'
+FORWARDING_DESTINATION = 'destination'
+
+# Seconds without traffic before a pair rule expires (0 never), and seconds between two
+# sweeps of the flow tables when a per switch budget of pair rules is set
+PAIR_IDLE_TIMEOUT = 300
+SWEEP_INTERVAL = 10
+
+# Bytes per second of the links without a known speed, weight of a saturated link on top of
+# its hop in the weighted costs and change of utilisation worth updating the weights
+LINK_CAPACITY = 125000000
+CONGESTION_WEIGHT = 4
+UTILISATION_STEP = 0.05
+
+# Cookie of the pair rules, the pair id in the low bits and the top bit set on the
+# rules of the edge switch responsible for the counters of the pair
+COOKIE_EDGE = 1 << 63
+COOKIE_PAIR_MASK = COOKIE_EDGE - 1
+
+# ARP and RARP sent to the controller are metered on each switch (packets per second),
+# then every source MAC gets its own token bucket on the controller
+ARP_METER_ID = 1
+ARP_METER_RATE = 1000
+ARP_METER_BURST = 100
+SOURCE_RATE = 50
+SOURCE_BURST = 100
+# Sources (and ARP floods) remembered, the least recently seen are forgotten first
+MAX_TRACKED_SOURCES = 4096
+
+# Upper bound on the number of equal-cost paths considered for a pair
+ECMP_MAX_PATHS = 16
+
+# Seconds a migration waits for the VM to show up at its new hypervisor
+MIGRATION_TIMEOUT = 120
+
+# Announced by the VMs after a live migration
+ETH_TYPE_RARP = 0x8035
+PACKET_TYPES = { ether.ETH_TYPE_ARP: 'arp', ETH_TYPE_RARP: 'rarp', ether.ETH_TYPE_IP: 'ipv4' }
+
+# File the state is saved to every SNAPSHOT_INTERVAL seconds and restored from at startup (None
+# disables it), the pairs not confirmed by the switches within RESTORE_TIMEOUT are dropped
+SNAPSHOT_PATH = None
+SNAPSHOT_INTERVAL = 30
+SNAPSHOT_VERSION = 1
+RESTORE_TIMEOUT = 30
+
+# Seconds a reconnected switch waits for the links of its paths before its stale rules are removed anyway
+RECONCILE_TIMEOUT = 30
+
+# Minimum time between two floods of a request for the same unknown IP on a switch
+ARP_FLOOD_INTERVAL = 1.0
+
 class NetworkPort(object):
+    __slots__ = ('id', 'port')
+
     def __init__(self, id, port):
         self.id = id
         self.port = port
 
 class NetworkLink(object):
+    __slots__ = ('src', 'dst')
+
     def __init__(self, src, dst):
         self.src = src
         self.dst = dst
@@ -36,6 +123,8 @@ class NetworkLink(object):
             return None
 
 class SrcDestMACPair(object):
+    __slots__ = ('src', 'dst')
+
     def __init__(self, src, dst):
         self.src = src
         self.dst = dst
@@ -55,8 +144,256 @@ class SrcDestMACPair(object):
 def dpid_to_str(dpid):
     return '{:016x}'.format(dpid)
 
+def link_key(u, v):
+    """ Key of the undirected link (or pair) between u and v """
+    return (u, v) if u < v else (v, u)
+
+ETH_HEADER = struct.Struct('!6s6sH')
+VLAN_HEADER = struct.Struct('!HH')
+ARP_HEADER = struct.Struct('!HHBBH6s4s6s4s')
+
+ARP_HW_TYPE_ETHERNET = 1
+
+ArpHeader = namedtuple('ArpHeader', ['opcode', 'src_mac', 'src_ip', 'dst_mac', 'dst_ip'])
+
+def classify_packet(data):
+    """ Read the ethertype straight from the packet-in data, skipping 802.1Q tags.
+        Returns (ethertype, offset of the payload) or (None, None) if truncated """
+    if len(data) < ETH_HEADER.size:
+        return None, None
+
+    ethertype, = struct.unpack_from('!H', data, 12)
+    offset = ETH_HEADER.size
+    while ethertype == ether.ETH_TYPE_8021Q:
+        if len(data) < offset + VLAN_HEADER.size:
+            return None, None
+        _, ethertype = VLAN_HEADER.unpack_from(data, offset)
+        offset += VLAN_HEADER.size
+
+    return ethertype, offset
+
+def parse_arp(data, offset):
+    """ Decode an Ethernet/IPv4 ARP header in place, None if it isn't one """
+    if len(data) < offset + ARP_HEADER.size:
+        return None
+
+    hwtype, proto, hlen, plen, opcode, src_mac, src_ip, dst_mac, dst_ip = ARP_HEADER.unpack_from(data, offset)
+    if hwtype != ARP_HW_TYPE_ETHERNET or proto != ether.ETH_TYPE_IP or hlen != 6 or plen != 4:
+        return None
+
+    return ArpHeader(opcode,
+        mac.haddr_to_str(src_mac), socket.inet_ntoa(src_ip),
+        mac.haddr_to_str(dst_mac), socket.inet_ntoa(dst_ip))
+
+class EventHostMoved(EventBase):
+    """ A host left its switch, dpid is the switch it moved to or None if unknown """
+    def __init__(self, mac, dpid):
+        super(EventHostMoved, self).__init__()
+        self.mac = mac
+        self.dpid = dpid
+
+class PathCache(object):
+    """ Shortest paths keyed by (src, dst), indexed by the nodes they traverse so
+        that topology events only drop the entries they can affect """
+    def __init__(self):
+        self.paths = {}
+        self.node_index = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.paths)
+
+    def get(self, src, dst):
+        path = self.paths.get((src, dst))
+        if path is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return path
+
+    def put(self, src, dst, path):
+        # The topology is undirected, the reverse path comes for free
+        self.paths[(src, dst)] = path
+        self.paths[(dst, src)] = path[::-1]
+
+        for n in path:
+            self.node_index.setdefault(n, set()).update(((src, dst), (dst, src)))
+
+    def discard(self, key):
+        path = self.paths.pop(key, None)
+        if path:
+            for n in path:
+                keys = self.node_index.get(n)
+                if keys:
+                    keys.discard(key)
+                    if not keys:
+                        del self.node_index[n]
+
+    def invalidate_node(self, node):
+        """ Drop every path going through (or ending at) node """
+        for key in list(self.node_index.get(node, ())):
+            self.discard(key)
+
+    def invalidate_link(self, u, v):
+        """ Drop every path using the link between u and v """
+        failed = link_key(u, v)
+        for key in list(self.node_index.get(u, set()) & self.node_index.get(v, set())):
+            path = self.paths[key]
+            if any(link_key(path[i], path[i+1]) == failed for i in range(len(path)-1)):
+                self.discard(key)
+
+    def invalidate_shortcuts(self, src_lengths, dst_lengths):
+        """ Drop the paths a new link (u, v) makes shorter, src_lengths and dst_lengths
+            are the hop counts from u and v once the link is in the topology """
+        inf = float('inf')
+        for key, path in list(self.paths.items()):
+            s, t = key
+            length = len(path) - 1
+            via_link = min(src_lengths.get(s, inf) + 1 + dst_lengths.get(t, inf),
+                           dst_lengths.get(s, inf) + 1 + src_lengths.get(t, inf))
+            if via_link < length:
+                self.discard(key)
+
+    def clear(self):
+        self.paths.clear()
+        self.node_index.clear()
+
+    def to_dict(self):
+        return {
+            'entries': len(self.paths),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+class InstalledPaths(object):
+    """ Installed paths, stored once per pair of hosts in the direction they were installed,
+        with the pairs indexed by MAC """
+    def __init__(self):
+        # link_key(src, dst) -> (src, dst, forward path, reverse path)
+        self.entries = {}
+        self.mac_index = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, pair):
+        return link_key(pair.src, pair.dst) in self.entries
+
+    def __getitem__(self, pair):
+        path = self.get(pair)
+        if path is None:
+            raise KeyError(str(pair))
+
+        return path
+
+    def get(self, pair, default=None):
+        """ Path of the SrcDestMACPair, in its direction """
+        entry = self.entries.get(link_key(pair.src, pair.dst))
+        if entry is None:
+            return default
+
+        src, dst, forward, reverse = entry
+        return forward if pair.src == src else reverse
+
+    def entry(self, key):
+        return self.entries.get(key)
+
+    def add(self, src, dst, forward, reverse):
+        key = link_key(src, dst)
+        self.entries[key] = (src, dst, forward, reverse)
+
+        self.mac_index.setdefault(src, set()).add(key)
+        self.mac_index.setdefault(dst, set()).add(key)
+
+    def remove(self, src, dst):
+        key = link_key(src, dst)
+        entry = self.entries.pop(key, None)
+
+        if entry:
+            for mac in key:
+                keys = self.mac_index[mac]
+                keys.discard(key)
+                if not keys:
+                    del self.mac_index[mac]
+
+        return entry
+
+    def pairs_of(self, mac):
+        """ (src, dst) of the pairs mac is part of, as they were installed """
+        return [self.entries[key][:2] for key in self.mac_index.get(mac, ())]
+
+    def peers(self, mac):
+        return [dst if src == mac else src for src, dst in self.pairs_of(mac)]
+
+    def items(self):
+        """ (SrcDestMACPair, path) in both directions """
+        for src, dst, forward, reverse in self.entries.values():
+            yield SrcDestMACPair(src, dst), forward
+            yield SrcDestMACPair(dst, src), reverse
+
+class FlowBatch(object):
+    """ FlowMods grouped per datapath, sent back to back by Routing.send_batch """
+    def __init__(self):
+        self.messages = OrderedDict()
+        self.paths = []
+        self.created = time.time()
+
+    def __len__(self):
+        return sum(len(msgs) for _, msgs in self.messages.values())
+
+    def add(self, datapath, msg):
+        self.messages.setdefault(datapath.id, (datapath, []))[1].append(msg)
+
+class FlowBatchCompletion(object):
+    """ Completes once every datapath of a batch answered its barrier (or left).
+        Don't wait() from an event handler, the barrier replies would never be dispatched """
+    def __init__(self, started, dpids):
+        self.started = started
+        self.pending = set(dpids)
+        self.failed = set()
+        self.duration = None
+
+        self._callbacks = []
+        self._event = hub.Event()
+
+        if not self.pending:
+            self._complete()
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+        return self.done()
+
+    def add_done_callback(self, callback):
+        if self.done():
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def confirm(self, dpid, failed=False):
+        self.pending.discard(dpid)
+        if failed:
+            self.failed.add(dpid)
+
+        if not self.pending and not self.done():
+            self._complete()
+
+    def _complete(self):
+        self.duration = time.time() - self.started
+        self._event.set()
+
+        for callback in self._callbacks:
+            callback(self)
+        self._callbacks = []
+
 class Routing(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+    _EVENTS = [EventHostMoved]
 
     def __init__(self, *args, **kwargs):
         super(Routing, self).__init__(*args, **kwargs)
@@ -65,11 +402,90 @@ class Routing(app_manager.RyuApp):
         self.mac_to_ip = {}
         self.ip_to_mac = {}
         self.topology = nx.Graph()
+        # (node, neighbour) -> port of node connected to neighbour (None for hosts)
+        self.ports = {}
+        # Bumped on every topology change, and the fabric version on the changes between switches
+        self.topology_version = 0
+        self.fabric_version = 0
+        self._compact_topology = None
+        # (topology version, hypervisor to hypervisor path costs), unweighted and weighted by the link utilisations
+        self._cost_matrix = None
+        self._weighted_cost_matrix = None
+        self.link_capacity = LINK_CAPACITY
+        self.utilisation_version = 0
 
         self.hypervisor_mac_to_dpid = { '90:b1:1c:87:72:c5': "0000000000000004" } 
         self.hypervisor_dpid_to_mac = { v: k for k, v in self.hypervisor_mac_to_dpid.items() }
 
-        self.installed_paths = {}
+        self.installed_paths = InstalledPaths()
+
+        self.forwarding_mode = FORWARDING_PAIR
+        # Spread the pairs over all the equal-cost paths (pair forwarding only)
+        self.ecmp = False
+        # link_key -> [number of pairs, traffic rate] routed over the link
+        self.link_usage = {}
+        # link_key of a pair -> last measured traffic rate
+        self.pair_rates = {}
+        # link_key -> link_key of the pairs whose paths (either direction) use the link
+        self.link_pairs = {}
+        # dpid -> link_key of the pairs with rules on the switch
+        self.switch_pairs = {}
+        self.link_repairs = deque(maxlen=256)
+
+        self.discovery = HostDiscovery(self, CONTROLLER_MAC)
+
+        # Pair rules lifecycle, each pair gets its own cookie and expires once idle,
+        # the sweeper keeps the number of pair rules per switch under flow_budget (None no limit)
+        self.idle_timeout = PAIR_IDLE_TIMEOUT
+        self.flow_budget = None
+        self.next_cookie = 1
+        self.pair_cookies = {}
+        self.cookie_pairs = {}
+        # link_key of a pair -> last time it was seen carrying traffic
+        self.pair_activity = {}
+        # link_key of a pair -> (eth_src, eth_dst) of the directions whose edge rule idled out
+        self.idle_directions = {}
+        self.sweeper_thread = hub.spawn(self._sweep_loop)
+
+        # VM MAC -> migration waiting for the VM to show up at its new hypervisor
+        self.pending_migrations = {}
+        self.migrations = deque(maxlen=256)
+
+        # Destination MAC -> { dpid: next hop } of the forwarding tree towards that host
+        self.installed_trees = {}
+
+        self.path_cache = PathCache()
+
+        # (dpid, xid) of the outstanding barriers -> FlowBatchCompletion
+        self.pending_barriers = {}
+        self.path_setup_times = deque(maxlen=1024)
+        self.first_packet_delays = deque(maxlen=1024)
+
+        # Answer ARP requests for known hosts instead of flooding them
+        self.proxy_arp = True
+        self.arp_floods = OrderedDict()
+
+        # Admission control of the packet-ins, dpid -> datapath of the switches with the ARP meter,
+        # MAC -> [tokens, last refill] and the counters
+        self.source_rate = SOURCE_RATE
+        self.source_burst = SOURCE_BURST
+        self.metered_switches = {}
+        self.source_buckets = OrderedDict()
+        self.admission = { 'accepted': 0, 'throttled': 0, 'meter_dropped': {} }
+
+        # (dpid, xid) -> flow stats received so far, of the flow tables requested by the routing
+        self.flow_requests = {}
+        # dpid -> rules reported by a reconnected switch, until they are checked against the installed paths
+        self.reconciling = {}
+        # dpid -> (MAC, IP, host type, port) of the hosts of a switch that left, attached again when it's back
+        self.detached_hosts = {}
+
+        # Warm restart, the hosts wait for their switch and the pairs for the switches to report their rules
+        self.snapshot_path = SNAPSHOT_PATH
+        self.restoring = None
+        if self.snapshot_path:
+            self.load_snapshot(self.snapshot_path)
+            self.snapshot_thread = hub.spawn(self._snapshot_loop)
 
     """ Triggered when the switch is being configure, make sure to redirect ARP packets that are relevant """
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
@@ -78,117 +494,739 @@ class Routing(app_manager.RyuApp):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
+        self.install_arp_rules(datapath)
+
+        # Don't want to redirect ARP request packets from the controller to the controller
+        match = parser.OFPMatch(eth_type=ether.ETH_TYPE_ARP, eth_src=CONTROLLER_MAC)
+        actions = [parser.OFPActionOutput(ofproto.OFPP_FLOOD)]
+        self.add_flow(datapath, ARP_PRIORITY, match, actions)
+
+        # IPv4 without a path, the path is installed reactively and the buffered packet released
+        match = parser.OFPMatch(eth_type=ether.ETH_TYPE_IP)
+        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, MISS_SEND_LEN)]
+        self.add_flow(datapath, MISS_PRIORITY, match, actions)
+
+        # The ARP rules get metered if the switch supports it
+        datapath.send_msg(parser.OFPMeterFeaturesStatsRequest(datapath, 0))
+
+    def install_arp_rules(self, datapath, meter_id=None):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
         match = parser.OFPMatch(eth_type=ether.ETH_TYPE_ARP)
         actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)]
 
         # Redirect all the ARP packets to the controller
-        self.add_flow(datapath, 1, match, actions)
+        self.add_flow(datapath, ARP_PRIORITY, match, actions, meter_id=meter_id)
 
-        # Don't want to redirect ARP request packets from the controller to the controller
-        match = parser.OFPMatch(eth_type=ether.ETH_TYPE_ARP, eth_src=CONTROLLER_MAC)
-        actions = [parser.OFPActionOutput(ofproto.OFPP_FLOOD)]
-        self.add_flow(datapath, 1, match, actions)
+        # VMs announce themselves with RARP after a live migration
+        match = parser.OFPMatch(eth_type=ETH_TYPE_RARP)
+        self.add_flow(datapath, ARP_PRIORITY, match, actions, meter_id=meter_id)
+
+    @set_ev_cls(ofp_event.EventOFPMeterFeaturesStatsReply, [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _meter_features_handler(self, ev):
+        datapath = ev.msg.datapath
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        # Switches without meters keep the unmetered rules, the per source buckets still apply
+        features = ev.msg.body[0] if ev.msg.body else None
+        if features is None or features.max_meter < 1 or not features.band_types & (1 << ofproto.OFPMBT_DROP) or not features.capabilities & ofproto.OFPMF_PKTPS:
+            LOG.info('No ARP meter on %s', dpid_to_str(datapath.id))
+            return
+
+        flags = ofproto.OFPMF_PKTPS
+        if features.capabilities & ofproto.OFPMF_BURST:
+            flags |= ofproto.OFPMF_BURST
+
+        # The meter may be left over from a previous controller, start from a clean one
+        band = parser.OFPMeterBandDrop(rate=ARP_METER_RATE, burst_size=ARP_METER_BURST)
+        datapath.send_msg(parser.OFPMeterMod(datapath, command=ofproto.OFPMC_DELETE, meter_id=ARP_METER_ID))
+        datapath.send_msg(parser.OFPMeterMod(datapath, command=ofproto.OFPMC_ADD, flags=flags, meter_id=ARP_METER_ID, bands=[band]))
+
+        self.install_arp_rules(datapath, ARP_METER_ID)
+        self.metered_switches[datapath.id] = datapath
+
+    def request_meter_stats(self):
+        for datapath in self.metered_switches.values():
+            datapath.send_msg(datapath.ofproto_parser.OFPMeterStatsRequest(datapath, 0, ARP_METER_ID))
+
+    @set_ev_cls(ofp_event.EventOFPMeterStatsReply, MAIN_DISPATCHER)
+    def _meter_stats_handler(self, ev):
+        for stats in ev.msg.body:
+            if stats.meter_id == ARP_METER_ID:
+                dropped = sum(band.packet_band_count for band in stats.band_stats)
+                self.admission['meter_dropped'][dpid_to_str(ev.msg.datapath.id)] = dropped
+
+    def admit(self, src, now):
+        """ Token bucket of the source MAC, False if its packet-in should be dropped """
+        # Moved to the end on every packet, the least recently seen sources come first
+        bucket = self.source_buckets.pop(src, None)
+        if bucket is None:
+            bucket = [self.source_burst, now]
+
+            # Spoofed sources would grow the buckets forever
+            if len(self.source_buckets) >= MAX_TRACKED_SOURCES:
+                self.source_buckets.popitem(last=False)
+        else:
+            bucket[0] = min(self.source_burst, bucket[0] + (now - bucket[1]) * self.source_rate)
+            bucket[1] = now
+
+        self.source_buckets[src] = bucket
+
+        if bucket[0] < 1:
+            self.admission['throttled'] += 1
+            return False
+
+        bucket[0] -= 1
+        self.admission['accepted'] += 1
+        return True
 
     @set_ev_cls(event.EventSwitchEnter)
     def _switch_enter_handler(self, ev):
-        print 'SWITCH enter', dpid_to_str(ev.switch.dp.id)
+        LOG.info('SWITCH enter %s', dpid_to_str(ev.switch.dp.id))
+        # A switch without links cannot shorten any path, only drop what went through a previous instance
+        self.path_cache.invalidate_node(dpid_to_str(ev.switch.dp.id))
         self.topology.add_node(dpid_to_str(ev.switch.dp.id), type='switch', obj=ev.switch)
+        self.topology_version += 1
+        self.fabric_version += 1
+
+        if self.restoring:
+            self.restore_switch(ev.switch.dp)
+
+        # Hosts still known and not seen anywhere else in the meantime
+        dpid = dpid_to_str(ev.switch.dp.id)
+        for mac, ip, host_type, port in self.detached_hosts.pop(dpid, []):
+            if self.mac_to_ip.get(mac) == ip and not self.get_hypervisor(mac):
+                self.attach_host(dpid, port, mac, ip, host_type)
+
+        # Whatever the switch kept is checked against what it should have
+        self.request_flows(ev.switch.dp)
 
     @set_ev_cls(event.EventSwitchLeave)
     def _switch_leave_handler(self, ev):
-        print 'SWITCH DISCONNECT', dpid_to_str(ev.switch.dp.id)
-        self.topology.remove_node(dpid_to_str(ev.switch.dp.id))
+        dpid = dpid_to_str(ev.switch.dp.id)
+        LOG.info('SWITCH DISCONNECT %s', dpid)
+        self.path_cache.invalidate_node(dpid)
+
+        # The links of the switch are deleted after it left, by then the switch is gone from the topology.
+        # The pairs going through it are rerouted now
+        if dpid in self.topology:
+            links = [(dpid, n) for n in self.topology[dpid] if self.topology.node[n].get('type') == 'switch']
+            if links:
+                self.repair_links(links, { 'switch': dpid })
+
+        # The hosts go with the links of the switch, they are remembered for when it reconnects
+        if dpid in self.topology:
+            self.detached_hosts[dpid] = [(n, self.mac_to_ip[n], self.topology.node[n]['type'], self.ports.get((dpid, n)))
+                for n in self.topology[dpid] if self.is_host(n) and n in self.mac_to_ip]
+            self.remove_node(dpid)
+        self.metered_switches.pop(ev.switch.dp.id, None)
+
+        # The barriers sent to this switch will never be answered
+        for key in [k for k in self.pending_barriers if k[0] == ev.switch.dp.id]:
+            self.pending_barriers.pop(key).confirm(key[0], failed=True)
 
 
     @set_ev_cls(event.EventLinkAdd)
     def _link_add_handler(self, ev):
-        print 'LINK ADD', ev.link
-        self.topology.add_edge(dpid_to_str(ev.link.src.dpid), dpid_to_str(ev.link.dst.dpid), type='link', obj=NetworkLink(NetworkPort(dpid_to_str(ev.link.src.dpid), ev.link.src.port_no), NetworkPort(dpid_to_str(ev.link.dst.dpid), ev.link.dst.port_no)))
+        LOG.info('LINK ADD %s', ev.link)
+        src = dpid_to_str(ev.link.src.dpid)
+        dst = dpid_to_str(ev.link.dst.dpid)
+        new_link = not self.topology.has_edge(src, dst)
+
+        self.add_link(NetworkLink(NetworkPort(src, ev.link.src.port_no), NetworkPort(dst, ev.link.dst.port_no)))
+
+        # The link is reported in both directions, only a new one can shorten cached paths
+        if new_link and len(self.path_cache):
+            self.path_cache.invalidate_shortcuts(
+                nx.single_source_shortest_path_length(self.topology, src),
+                nx.single_source_shortest_path_length(self.topology, dst)
+            )
+
+        # The restored pairs and the reconnected switches wait for the links of their paths
+        if self.restoring and new_link:
+            self.restore_pairs()
+        if self.reconciling and new_link:
+            self.reconcile_switches()
 
     @set_ev_cls(event.EventLinkDelete)
     def _link_del_handler(self, ev):
-        print 'LINK DELETE NYI', ev.link
+        LOG.info('LINK DELETE %s', ev.link)
+        src = dpid_to_str(ev.link.src.dpid)
+        dst = dpid_to_str(ev.link.dst.dpid)
+
+        # The link is reported in both directions, only repair once
+        if not self.topology.has_edge(src, dst):
+            return
+
+        self.repair_links([(src, dst)], { 'link': [src, dst] })
+
+    def repair_links(self, links, cause):
+        """ Remove the links from the topology and reroute the pairs that went over them in one batch """
+        batch = FlowBatch()
+
+        # Only the pairs routed over the links are affected, the flows are removed
+        # while the links are still in the topology as their ports are needed
+        keys = set()
+        for src, dst in links:
+            keys.update(self.link_pairs.pop(link_key(src, dst), ()))
+
+        pairs = []
+        for key in keys:
+            entry = self.installed_paths.entry(key)
+            if entry:
+                pairs.append(entry[:2])
+
+        for src, dst in links:
+            self.prune_trees(src, dst, batch)
+        for pair_src, pair_dst in pairs:
+            self.uninstall_path(pair_src, pair_dst, self.installed_paths[SrcDestMACPair(pair_src, pair_dst)], batch)
+
+        for src, dst in links:
+            self.path_cache.invalidate_link(src, dst)
+            self.remove_link(src, dst)
+
+        repaired = 0
+        for pair_src, pair_dst in pairs:
+            try:
+                self.install_path(pair_src, pair_dst, batch)
+                repaired += 1
+            except nx.NetworkXException:
+                LOG.warning('no path left between %s and %s', pair_src, pair_dst)
+
+        # Time from the link (or switch) down event to the last repaired flow being confirmed
+        def repaired_callback(completion):
+            repair = {
+                'pairs': len(pairs),
+                'repaired': repaired,
+                'duration': completion.duration
+            }
+            repair.update(cause)
+            self.link_repairs.append(repair)
+            LOG.info('%s repaired %d/%d pairs in %.3fs', cause, repaired, len(pairs), completion.duration)
+
+        self.send_batch(batch).add_done_callback(repaired_callback)
+
+    def prune_trees(self, u, v, batch):
+        """ Remove from the forwarding trees the switches that reach the destination over the
+            link between u and v, the pairs using them are reinstalled which regrows the trees """
+        failed = link_key(u, v)
+
+        for dst, tree in self.installed_trees.items():
+            if tree.get(u) != v and tree.get(v) != u:
+                continue
+
+            broken = set()
+            intact = set()
+            for switch_dpid in tree:
+                chain = []
+                node = switch_dpid
+                while node in tree and node not in broken and node not in intact and len(chain) <= len(tree):
+                    chain.append(node)
+                    if link_key(node, tree[node]) == failed:
+                        node = None
+                        break
+                    node = tree[node]
+
+                if node is None or node in broken:
+                    broken.update(chain)
+                else:
+                    intact.update(chain)
+
+            for switch_dpid in broken:
+                datapath = self.get_datapath(switch_dpid)
+                self.remove_flow(datapath, datapath.ofproto_parser.OFPMatch(eth_dst=dst), batch, priority=TREE_PRIORITY)
+                del tree[switch_dpid]
 
     def add_host(self, datapath, in_port, src_mac, src_ip):
         ofproto = datapath.ofproto
 
-        if (src_mac not in self.mac_to_ip) and (src_mac != CONTROLLER_MAC) and src_ip != '0.0.0.0':
-            print 'adding entry:', src_mac, src_ip, in_port, dpid_to_str(datapath.id)
-            self.mac_to_ip[src_mac] = src_ip
-            self.ip_to_mac[src_ip]  = src_mac
+        # A known host is only attached again if it lost its switch and shows up on an edge port
+        if src_mac in self.mac_to_ip and (self.get_hypervisor(src_mac) or not self.is_edge_port(dpid_to_str(datapath.id), in_port)):
+            return
 
-            if in_port == ofproto.OFPP_LOCAL:
-                print 'local port, this is the hypervisor !', src_mac
-                self.hypervisor_mac_to_dpid[src_mac] = dpid_to_str(datapath.id)
-                self.hypervisor_dpid_to_mac[dpid_to_str(datapath.id)] = src_mac
+        if (src_mac != CONTROLLER_MAC) and src_ip != '0.0.0.0':
+            LOG.debug('adding entry: %s %s %s %s', src_mac, src_ip, in_port, dpid_to_str(datapath.id))
 
+            if in_port == ofproto.OFPP_LOCAL:
+                LOG.info('local port, this is the hypervisor ! %s', src_mac)
                 host_type = 'hypervisor'
             else:
-                print 'adding VM', src_mac
+                LOG.info('adding VM %s', src_mac)
                 host_type = 'vm'
 
-            self.topology.add_node(src_mac, type=host_type)
-            self.topology.add_edge(src_mac, dpid_to_str(datapath.id), type='link', obj=NetworkLink(NetworkPort(src_mac, None), NetworkPort(dpid_to_str(datapath.id), in_port)))
+            self.attach_host(dpid_to_str(datapath.id), in_port, src_mac, src_ip, host_type)
+
+    def attach_host(self, dpid, port, mac, ip, host_type):
+        self.mac_to_ip[mac] = ip
+        self.ip_to_mac[ip]  = mac
+
+        if host_type == 'hypervisor':
+            self.hypervisor_mac_to_dpid[mac] = dpid
+            self.hypervisor_dpid_to_mac[dpid] = mac
+
+        # Hosts are leaves, only their own paths can change
+        self.path_cache.invalidate_node(mac)
+        self.topology.add_node(mac, type=host_type)
+        self.add_link(NetworkLink(NetworkPort(mac, None), NetworkPort(dpid, port)))
+
+        self.discovery.resolved(ip, mac)
+
+    def add_link(self, link):
+        """ Add a link to the topology, with its ports in the port table """
+        self.topology.add_edge(link.src.id, link.dst.id, type='link', obj=link)
+        self.ports[(link.src.id, link.dst.id)] = link.src.port
+        self.ports[(link.dst.id, link.src.id)] = link.dst.port
+        self.topology_changed(link.src.id, link.dst.id)
+
+    def remove_link(self, u, v):
+        self.topology_changed(u, v)
+        self.topology.remove_edge(u, v)
+        self.ports.pop((u, v), None)
+        self.ports.pop((v, u), None)
+
+    def remove_node(self, node):
+        for neighbour in self.topology[node]:
+            self.ports.pop((node, neighbour), None)
+            self.ports.pop((neighbour, node), None)
+
+        self.topology_changed(node)
+        self.topology.remove_node(node)
+
+    def topology_changed(self, *nodes):
+        self.topology_version += 1
+        if all(self.topology.node[n].get('type') == 'switch' for n in nodes):
+            self.fabric_version += 1
+
+    def compact_topology(self):
+        """ Array backed snapshot of the switch fabric, rebuilt when a switch or a link between
+            switches changed """
+        if self._compact_topology is None or self._compact_topology.version != self.fabric_version:
+            self._compact_topology = CompactTopology(self.topology, self.fabric_version)
+
+        return self._compact_topology
 
     def remove_host(self, src_mac):
         src_ip = self.mac_to_ip.pop(src_mac, None)
         if src_ip:
             self.ip_to_mac.pop(src_ip, None)
 
-    def add_flow(self, datapath, priority, match, actions):
+    def add_flow(self, datapath, priority, match, actions, batch=None, cookie=0, idle_timeout=0, flags=0, meter_id=None):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
         inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]
-        mod = parser.OFPFlowMod(datapath=datapath, priority=priority, match=match, instructions=inst)
+        if meter_id is not None:
+            inst.insert(0, parser.OFPInstructionMeter(meter_id))
+        mod = parser.OFPFlowMod(datapath=datapath, cookie=cookie, idle_timeout=idle_timeout, flags=flags, priority=priority, match=match, instructions=inst)
 
-        datapath.send_msg(mod)
+        FLOW_MODS.inc('add')
+        self.send_flow_mod(datapath, mod, batch)
 
-    def remove_flow(self, datapath, match):
+    def remove_flow(self, datapath, match, batch=None, priority=None):
+        """ Remove the flows matching match, only the one with that exact match and priority if given """
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
-        mod = parser.OFPFlowMod(datapath=datapath, match=match, command=ofproto.OFPFC_DELETE, out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY)
-        datapath.send_msg(mod)
+        if priority is None:
+            mod = parser.OFPFlowMod(datapath=datapath, match=match, command=ofproto.OFPFC_DELETE, out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY)
+        else:
+            mod = parser.OFPFlowMod(datapath=datapath, match=match, priority=priority, command=ofproto.OFPFC_DELETE_STRICT, out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY)
+
+        FLOW_MODS.inc('delete')
+        self.send_flow_mod(datapath, mod, batch)
+
+    def send_flow_mod(self, datapath, mod, batch=None):
+        if batch is None:
+            datapath.send_msg(mod)
+        else:
+            batch.add(datapath, mod)
+
+    def send_batch(self, batch):
+        """ Send the FlowMods of the batch, each datapath gets its messages back to back
+            followed by a single barrier. Returns a FlowBatchCompletion """
+        completion = FlowBatchCompletion(batch.created, batch.messages.keys())
+
+        for dpid, (datapath, msgs) in batch.messages.items():
+            for msg in msgs:
+                datapath.send_msg(msg)
+
+            barrier = datapath.ofproto_parser.OFPBarrierRequest(datapath)
+            datapath.set_xid(barrier)
+            self.pending_barriers[(dpid, barrier.xid)] = completion
+            datapath.send_msg(barrier)
+
+        if batch.paths:
+            paths = list(batch.paths)
+            completion.add_done_callback(lambda c: self.record_path_setup(paths, c))
+
+        return completion
+
+    def record_path_setup(self, paths, completion):
+        for src, dst in paths:
+            self.path_setup_times.append({
+                'src': src,
+                'dst': dst,
+                'duration': completion.duration,
+                'failed': [dpid_to_str(dpid) for dpid in completion.failed]
+            })
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def _flow_removed_handler(self, ev):
+        # The deletes the controller sent come back too, and may share the cookie of a live pair
+        ofproto = ev.msg.datapath.ofproto
+        if ev.msg.reason != ofproto.OFPRR_IDLE_TIMEOUT and ev.msg.reason != ofproto.OFPRR_HARD_TIMEOUT:
+            return
+
+        key = self.cookie_pairs.get(ev.msg.cookie & COOKIE_PAIR_MASK)
+        if key is None or not self.installed_paths.entry(key):
+            return
+
+        # Each direction expires on its own, one way traffic keeps the pair. Once both did the rest of the pair goes
+        expired = self.idle_directions.setdefault(key, set())
+        expired.add((ev.msg.match.get('eth_src'), ev.msg.match.get('eth_dst')))
+        if len(expired) < 2:
+            return
+
+        src, dst = self.installed_paths.entry(key)[:2]
+        LOG.debug('Path from %s to %s expired', src, dst)
+        self.uninstall_path(src, dst, self.installed_paths[SrcDestMACPair(src, dst)])
+
+    def _sweep_loop(self):
+        while True:
+            hub.sleep(SWEEP_INTERVAL)
+
+            # An error must not stop the sweeps nor the meter stats for good
+            try:
+                self.request_meter_stats()
+                if self.flow_budget:
+                    self.sweep()
+            except Exception:
+                LOG.exception('sweep failed')
+
+    def sweep(self):
+        """ Evict the least recently active pairs of the switches above their budget of pair rules """
+        batch = FlowBatch()
+
+        for switch_dpid, keys in list(self.switch_pairs.items()):
+            # Two rules per pair on each of its switches
+            excess = len(keys) - self.flow_budget // 2
+            if excess <= 0:
+                continue
+
+            for key in sorted(keys, key=lambda k: self.pair_activity.get(k, 0))[:excess]:
+                entry = self.installed_paths.entry(key)
+                if entry:
+                    src, dst = entry[:2]
+                    LOG.debug('Evicting path from %s to %s from %s', src, dst, switch_dpid)
+                    self.uninstall_path(src, dst, self.installed_paths[SrcDestMACPair(src, dst)], batch)
+
+        if len(batch):
+            self.send_batch(batch)
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def _barrier_reply_handler(self, ev):
+        completion = self.pending_barriers.pop((ev.msg.datapath.id, ev.msg.xid), None)
+        if completion:
+            completion.confirm(ev.msg.datapath.id)
 
     def get_path(self, src, dst):
-        path = nx.shortest_path(self.topology, source=src, target=dst)
+        path = self.path_cache.get(src, dst)
+        if path is None:
+            start = time.time()
+            path = self.shortest_path(src, dst)
+            PATH_SECONDS.observe(time.time() - start)
+            self.path_cache.put(src, dst, path)
+
         return path
 
-    def install_path(self, src, dst):
-        print 'Installing path from {} to {}'.format(src, dst)
-        path = self.get_path(src, dst)
-        print path
+    def shortest_path(self, src, dst):
+        """ Hosts are leaves, only the path between their switches is searched """
+        src_switch = self.get_hypervisor(src) if self.is_host(src) else src
+        dst_switch = self.get_hypervisor(dst) if self.is_host(dst) else dst
+        if src_switch is None or dst_switch is None:
+            raise nx.NetworkXNoPath('{} or {} not attached to a switch'.format(src, dst))
+
+        path = self.compact_topology().shortest_path(src_switch, dst_switch)
+        if src_switch != src:
+            path.insert(0, src)
+        if dst_switch != dst:
+            path.append(dst)
+
+        return path
+
+    def get_port(self, dpid, neighbour):
+        """ Port of switch dpid connected to neighbour """
+        return self.ports[(dpid, neighbour)]
 
+    def get_datapath(self, dpid):
+        return self.topology.node[dpid]['obj'].dp
+
+    def install_paths(self, pairs):
+        """ Install the paths between all the (src, dst) pairs in one batch, returns its completion """
+        batch = FlowBatch()
+        for src, dst in pairs:
+            self.install_path(src, dst, batch)
+
+        return self.send_batch(batch)
+
+    def install_path(self, src, dst, batch=None):
         ### Install route between source and destination
         #  Check if the path hasn't been installed already, otherwise
         #  it installs a flow that already exists and therefore resets
         #  the counters
         installed_path = self.installed_paths.get(SrcDestMACPair(src, dst))
-        if not installed_path:
-            for i in range(1, len(path)-1): # Iterate only over the switches
-                switch_dpid = path[i]
-                switch_edges = self.topology[switch_dpid]
-                switch = self.topology.node[switch_dpid]['obj']
+        if installed_path:
+            return installed_path
+
+        # Installed on its own, the batch is sent once the rules are all there
+        if batch is None:
+            batch = FlowBatch()
+            path = self.install_path(src, dst, batch)
+            self.send_batch(batch)
+            return path
+
+        LOG.debug('Installing path from %s to %s', src, dst)
+        if self.forwarding_mode == FORWARDING_DESTINATION:
+            path = self.install_tree_path(src, dst, batch)
+        else:
+            path = self.install_pair_path(src, dst, batch)
 
-                ingress = switch_edges[path[i-1]]['obj']
-                egress  = switch_edges[path[i+1]]['obj']
+        batch.paths.append((src, dst))
+        return path
 
-                ingress_port = ingress.getPortById(switch_dpid).port
-                egress_port = egress.getPortById(switch_dpid).port
+    def allocate_cookie(self):
+        # Never reused, late flow removed messages of a previous install are ignored
+        cookie = self.next_cookie
+        self.next_cookie += 1
+        return cookie
+
+    def record_path(self, src, dst, forward, reverse, cookie):
+        """ Bookkeeping of an installed pair, its paths, cookie, the links it uses and their load """
+        key = link_key(src, dst)
+        self.installed_paths.add(src, dst, forward, reverse)
+        self.account_path(forward, 1, self.pair_rates.get(key, 0))
+        self.index_pair_links(key, True)
+
+        self.pair_cookies[key] = cookie
+        self.cookie_pairs[cookie] = key
+        self.pair_activity[key] = time.time()
+
+    def forget_path(self, src, dst):
+        """ Undo record_path, returns the cookie of the pair """
+        key = link_key(src, dst)
+        if self.installed_paths.entry(key):
+            self.index_pair_links(key, False)
+
+            # The load is accounted on the path in the direction it was installed
+            entry = self.installed_paths.remove(src, dst)
+            self.account_path(entry[2], -1, -self.pair_rates.get(key, 0))
+
+        self.pair_activity.pop(key, None)
+        self.idle_directions.pop(key, None)
+        cookie = self.pair_cookies.pop(key, None)
+        self.cookie_pairs.pop(cookie, None)
+        return cookie
+
+    def pair_switches(self, key):
+        """ Switches holding rules of the pair """
+        _, _, forward, reverse = self.installed_paths.entry(key)
+        if self.forwarding_mode == FORWARDING_DESTINATION:
+            return [forward[1]]
+
+        return forward[1:-1]
+
+    def index_pair_links(self, key, add):
+        _, _, forward, reverse = self.installed_paths.entry(key)
+        for path in (forward, reverse):
+            for i in range(len(path)-1):
+                link = link_key(path[i], path[i+1])
+                if add:
+                    self.link_pairs.setdefault(link, set()).add(key)
+                elif link in self.link_pairs:
+                    self.link_pairs[link].discard(key)
+                    if not self.link_pairs[link]:
+                        del self.link_pairs[link]
+
+        for switch_dpid in self.pair_switches(key):
+            if add:
+                self.switch_pairs.setdefault(switch_dpid, set()).add(key)
+            elif switch_dpid in self.switch_pairs:
+                self.switch_pairs[switch_dpid].discard(key)
+                if not self.switch_pairs[switch_dpid]:
+                    del self.switch_pairs[switch_dpid]
+
+    def install_pair_path(self, src, dst, batch):
+        if self.ecmp:
+            path = self.get_ecmp_path(src, dst)
+        else:
+            path = self.get_path(src, dst)
+        LOG.debug('Path %s', path)
 
-                parser = switch.dp.ofproto_parser
+        cookie = self.allocate_cookie()
+        self.install_rules(self.path_rules(src, dst, path), batch, cookie, edge=path[1])
 
-                self.add_flow(switch.dp, 0, parser.OFPMatch(in_port=ingress_port, eth_src=src, eth_dst=dst), [parser.OFPActionOutput(egress_port)])
-                self.add_flow(switch.dp, 0, parser.OFPMatch(in_port=egress_port, eth_src=dst, eth_dst=src), [parser.OFPActionOutput(ingress_port)])
+        self.record_path(src, dst, path, path[::-1], cookie)
+        LOG.debug('Path installed from %s to %s', src, dst)
 
+        return path
 
-            self.installed_paths[SrcDestMACPair(src, dst)] = path
-            self.installed_paths[SrcDestMACPair(dst, src)] = path[::-1]
-            print 'Path installed from {} to {}'.format(src, dst)
+    def lookup_port(self, dpid, neighbour, ports=None):
+        if ports and (dpid, neighbour) in ports:
+            return ports[(dpid, neighbour)]
+
+        return self.get_port(dpid, neighbour)
+
+    def path_rules(self, src, dst, path, ports=None, removing=False):
+        """ Pair rules of a path, { (dpid, in_port, eth_src, eth_dst): out_port } for both directions.
+            ports overrides the port of (dpid, neighbour), a switch with a None port is left out.
+            When removing, so is a switch whose ports are gone with it """
+        rules = {}
+        for i in range(1, len(path)-1): # Iterate only over the switches
+            switch_dpid = path[i]
+
+            try:
+                ingress_port = self.lookup_port(switch_dpid, path[i-1], ports)
+                egress_port = self.lookup_port(switch_dpid, path[i+1], ports)
+            except KeyError:
+                if not removing:
+                    raise
+                continue
+
+            if ingress_port is None or egress_port is None:
+                continue
+
+            rules[(switch_dpid, ingress_port, src, dst)] = egress_port
+            rules[(switch_dpid, egress_port, dst, src)] = ingress_port
+
+        return rules
+
+    def install_rules(self, rules, batch, cookie, idle_timeout=None, edge=None):
+        """ Install pair rules, they notify the controller when they expire. The ones on
+            the edge switch are tagged to have the stats of the pair, and only they expire,
+            one rule per direction """
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+
+        for (switch_dpid, in_port, eth_src, eth_dst), out_port in rules.items():
+            datapath = self.get_datapath(switch_dpid)
+            parser = datapath.ofproto_parser
+            self.add_flow(datapath, PAIR_PRIORITY, parser.OFPMatch(in_port=in_port, eth_src=eth_src, eth_dst=eth_dst), [parser.OFPActionOutput(out_port)], batch,
+                cookie=cookie | COOKIE_EDGE if switch_dpid == edge else cookie, idle_timeout=idle_timeout if switch_dpid == edge else 0,
+                flags=datapath.ofproto.OFPFF_SEND_FLOW_REM)
+
+    def revive_direction(self, src, dst, batch):
+        """ Install again the edge rule of the direction from src to dst if it idled out, returns whether it did """
+        key = link_key(src, dst)
+        expired = self.idle_directions.get(key)
+        if not expired or (src, dst) not in expired:
+            return False
+
+        expired.discard((src, dst))
+        pair_src, pair_dst, forward, reverse = self.installed_paths.entry(key)
+        rules = self.pair_rules(pair_src, pair_dst, forward, reverse)
+        self.install_rules({ k: v for k, v in rules.items() if k[0] == forward[1] and k[2] == src }, batch, self.pair_cookies[key], edge=forward[1])
+        return True
+
+    def remove_rules(self, rules, batch):
+        for switch_dpid, in_port, eth_src, eth_dst in rules:
+            if switch_dpid in self.topology:
+                datapath = self.get_datapath(switch_dpid)
+                self.remove_flow(datapath, datapath.ofproto_parser.OFPMatch(in_port=in_port, eth_src=eth_src, eth_dst=eth_dst), batch)
+
+    def get_ecmp_path(self, src, dst):
+        """ Least loaded of the equal-cost shortest paths between src and dst """
+        paths = itertools.islice(nx.all_shortest_paths(self.topology, source=src, target=dst), ECMP_MAX_PATHS)
+        return min(paths, key=self.path_load)
+
+    def path_load(self, path):
+        """ (traffic rate, number of pairs) of the busiest link of the path """
+        usage = [self.link_usage.get(link_key(path[i], path[i+1]), (0, 0)) for i in range(len(path)-1)]
+        return (max(u[1] for u in usage), max(u[0] for u in usage))
+
+    def account_path(self, path, pairs, rate):
+        for i in range(len(path)-1):
+            key = link_key(path[i], path[i+1])
+            usage = self.link_usage.setdefault(key, [0, 0])
+            usage[0] += pairs
+            usage[1] += rate
+
+            if usage[0] <= 0:
+                del self.link_usage[key]
+
+    def update_pair_rate(self, mac1, mac2, rate):
+        """ Measured traffic rate between two hosts, moves the load of its links accordingly """
+        key = link_key(mac1, mac2)
+        previous = self.pair_rates.get(key, 0)
+        self.pair_rates[key] = rate
+
+        if rate > 0 and key in self.pair_activity:
+            self.pair_activity[key] = time.time()
+
+        entry = self.installed_paths.entry(key)
+        if entry:
+            self.account_path(entry[2], 0, rate - previous)
+
+    def get_tree_path(self, src, dst):
+        """ Shortest path from src to dst until it reaches a switch that is already part of the
+            forwarding tree of dst, the tree is followed from there so each switch keeps one rule """
+        tree = self.installed_trees.get(dst)
+        path = self.get_path(src, dst)
+        if not tree:
+            return path
+
+        for i in range(1, len(path)-1):
+            node = path[i]
+            if node in tree:
+                tree_path = path[:i+1]
+                while node != dst and len(tree_path) <= len(tree) + 2:
+                    node = tree[node]
+                    tree_path.append(node)
+                return tree_path
 
         return path
 
+    def install_tree(self, path, batch):
+        """ Add the switches of path to the forwarding tree of its destination """
+        dst = path[-1]
+        tree = self.installed_trees.setdefault(dst, {})
+
+        for i in range(1, len(path)-1):
+            switch_dpid = path[i]
+            if switch_dpid in tree:
+                # The rest of the path is already part of the tree
+                break
+
+            datapath = self.get_datapath(switch_dpid)
+            parser = datapath.ofproto_parser
+            self.add_flow(datapath, TREE_PRIORITY, parser.OFPMatch(eth_dst=dst), [parser.OFPActionOutput(self.get_port(switch_dpid, path[i+1]))], batch)
+            tree[switch_dpid] = path[i+1]
+
+    def uninstall_tree(self, dst, batch=None):
+        """ Remove the forwarding tree of dst, and with it every pair rule towards dst """
+        for switch_dpid in self.installed_trees.pop(dst, {}):
+            if switch_dpid in self.topology:
+                datapath = self.get_datapath(switch_dpid)
+                self.remove_flow(datapath, datapath.ofproto_parser.OFPMatch(eth_dst=dst), batch)
+
+    def install_tree_path(self, src, dst, batch):
+        forward = self.get_tree_path(src, dst)
+        reverse = self.get_tree_path(dst, src)
+
+        self.install_tree(forward, batch)
+        self.install_tree(reverse, batch)
+
+        # The pair rules are only kept at the source edge switch, where the flow stats are read,
+        # they forward like the trees do but count the traffic of the pair in both directions
+        cookie = self.allocate_cookie()
+        self.install_rules(self.pair_rules(src, dst, forward, reverse), batch, cookie, edge=forward[1])
+
+        self.record_path(src, dst, forward, reverse, cookie)
+        LOG.debug('Path installed from %s to %s following the trees', src, dst)
+
+        return forward
+
     def get_hypervisor(self, mac):
         if mac in self.topology:
             adjacencies = self.topology[mac]
@@ -199,21 +1237,55 @@ class Routing(app_manager.RyuApp):
         return None
 
 
-    def calculate_path_cost(self, src, dst):
+    def update_port_rate(self, dpid, port_no, rate):
+        """ Transmit rate of a switch port, sets the utilisation of its link and the weight
+            used by the weighted costs """
+        node = dpid_to_str(dpid)
+        if node not in self.topology:
+            return
+
+        for neighbour in self.topology[node]:
+            if self.ports.get((node, neighbour)) == port_no and self.topology.node[neighbour].get('type') == 'switch':
+                break
+        else:
+            return
+
+        # The busiest direction
+        edge = self.topology[node][neighbour]
+        edge.setdefault('rates', {})[node] = rate
+        utilisation = max(edge['rates'].values()) / float(self.link_capacity)
+        edge['utilisation'] = utilisation
+
+        # Small changes keep the weights, the weighted costs are only computed again after significant ones
+        if abs(utilisation - edge.get('weighted_utilisation', 0)) >= UTILISATION_STEP:
+            edge['weighted_utilisation'] = utilisation
+            edge['weight'] = 1 + CONGESTION_WEIGHT * min(utilisation, 1.0)
+            self.utilisation_version += 1
+
+    def calculate_path_cost(self, src, dst, weighted=False):
         # Link Cost
         if not self.topology.node.get(src) or not self.topology.node.get(dst):
-            print '{} or {} not in the topology'.format(src, dst)
+            LOG.debug('%s or %s not in the topology', src, dst)
             return None
 
-        path = nx.shortest_path(self.topology,
-            source=src,
-            target=dst
-        )
+        # Weighted, the path avoids the busy links and they cost more
+        if weighted:
+            path = nx.dijkstra_path(self.topology, src, dst, weight='weight')
+            weight = sum(self.topology[path[i]][path[i+1]].get('weight', 1) for i in range(len(path)-1))
+            return self.path_cost(len(path)-1, weight)
+
+        path = self.get_path(src, dst)
 
         # print path
-        nb_switches = len(path[1:-1]) # 1:-1 to remove source and dest
-        nb_links = len(path)-1
+        return self.path_cost(len(path)-1)
+
+    def path_cost(self, nb_links, weight=None):
+        nb_switches = max(nb_links - 1, 0) # to remove source and dest, none between a switch and itself
         max_cost = nb_links / 2
+
+        # Weighted, only the congestion above one per link adds to the cost so an idle fabric costs the same
+        if weight is not None and weight > nb_links:
+            max_cost += (weight - nb_links) / 2.0
         sum_cost = max_cost * (max_cost + 1)
 
         return {
@@ -223,59 +1295,257 @@ class Routing(app_manager.RyuApp):
             'total_cost': sum_cost
         }
 
-    def uninstall_path(self, src, dst, path):
-        for i in range(1, len(path)-1): # Iterate only over the switches
-            switch_dpid = path[i]
-            switch_edges = self.topology[switch_dpid]
-            switch = self.topology.node[switch_dpid]['obj']
-
-            ingress = switch_edges[path[i-1]]['obj']
-            egress  = switch_edges[path[i+1]]['obj']
-
-            ingress_port = ingress.getPortById(switch_dpid).port
-            egress_port = egress.getPortById(switch_dpid).port
-
-            datapath = switch.dp
-            parser = switch.dp.ofproto_parser
-            self.remove_flow(datapath, parser.OFPMatch(in_port=ingress_port, eth_src=src, eth_dst=dst))
-            self.remove_flow(datapath, parser.OFPMatch(in_port=egress_port, eth_src=dst, eth_dst=src))
+    def cost_matrix(self, weighted=False):
+        """ Path costs between all the hypervisor switches, one BFS per switch and computed once per
+            topology version. Unreachable switches are left out """
+        if weighted:
+            return self.weighted_cost_matrix()
+
+        if self._cost_matrix is not None and self._cost_matrix[0] == self.topology_version:
+            return self._cost_matrix
+
+        compact = self.compact_topology()
+        dpids = [dpid for dpid in set(self.hypervisor_mac_to_dpid.values()) if dpid in compact]
+
+        matrix = {}
+        for src in dpids:
+            distances = compact.distances(src)
+            matrix[src] = {}
+            for dst in dpids:
+                nb_links = distances[compact.ids[dst]]
+                if nb_links >= 0:
+                    matrix[src][dst] = self.path_cost(nb_links)
+
+        self._cost_matrix = (self.topology_version, matrix)
+        return self._cost_matrix
+
+    def weighted_cost_matrix(self):
+        """ Same with the link utilisations, computed again when the topology or a weight changed """
+        version = '{}-{}'.format(self.topology_version, self.utilisation_version)
+        if self._weighted_cost_matrix is not None and self._weighted_cost_matrix[0] == version:
+            return self._weighted_cost_matrix
+
+        dpids = [dpid for dpid in set(self.hypervisor_mac_to_dpid.values()) if dpid in self.topology]
+
+        matrix = {}
+        for src in dpids:
+            weights, paths = nx.single_source_dijkstra(self.topology, src, weight='weight')
+            matrix[src] = { dst: self.path_cost(len(paths[dst])-1, weights[dst]) for dst in dpids if dst in paths }
+
+        self._weighted_cost_matrix = (version, matrix)
+        return self._weighted_cost_matrix
+
+    def uninstall_path(self, src, dst, path, batch=None):
+        if batch is None:
+            batch = FlowBatch()
+            self.uninstall_path(src, dst, path, batch)
+            return self.send_batch(batch)
+
+        if self.forwarding_mode == FORWARDING_DESTINATION:
+            # Pair rules are only at one of the edges, the trees are shared and stay
+            for switch_dpid in set((path[1], path[-2])):
+                if switch_dpid not in self.topology:
+                    continue
+
+                datapath = self.get_datapath(switch_dpid)
+                parser = datapath.ofproto_parser
+                self.remove_flow(datapath, parser.OFPMatch(eth_src=src, eth_dst=dst), batch)
+                self.remove_flow(datapath, parser.OFPMatch(eth_src=dst, eth_dst=src), batch)
+        else:
+            self.remove_rules(self.path_rules(src, dst, path, removing=True), batch)
 
-            if SrcDestMACPair(src, dst) in self.installed_paths:
-                del self.installed_paths[SrcDestMACPair(src, dst)]
-            if SrcDestMACPair(dst, src) in self.installed_paths:
-                del self.installed_paths[SrcDestMACPair(dst, src)]
+        self.forget_path(src, dst)
 
     def migrate(self, mac):
         self.remove_host(mac)
         # Remove all the installed flows with the src MAC
-        for k,v in self.installed_paths.items():
-            if k.src == mac or k.dst == mac:
-                self.uninstall_path(k.src, k.dst, v)
+        batch = FlowBatch()
+        for src, dst in self.installed_paths.pairs_of(mac):
+            self.uninstall_path(src, dst, self.installed_paths[SrcDestMACPair(src, dst)], batch)
+
+        # Nothing should be forwarded to the old location anymore
+        self.uninstall_tree(mac, batch)
+        self.send_batch(batch)
 
         # Find current hypervisor
         current_hypervisor = self.get_hypervisor(mac)
 
         # Update the topology
-        self.topology.remove_edge(current_hypervisor, mac)
-        # self.topology.add_edge(new_hypervisor, mac, type='link')
-        # self.topology.add_edge(new_hypervisor, mac, type='link', obj=NetworkLink(NetworkPort(src_mac, None), NetworkPort(dpid_to_str(datapath.id), in_port)))
+        self.path_cache.invalidate_node(mac)
+        if current_hypervisor:
+            self.remove_link(current_hypervisor, mac)
+
+        self.send_event_to_observers(EventHostMoved(mac, None))
+
+    def migrated_path(self, src, dst, mac, hypervisor):
+        """ Path between src and dst once mac is attached to hypervisor """
+        if src == mac:
+            return [mac] + self.get_path(hypervisor, dst)
+
+        return self.get_path(src, hypervisor) + [mac]
+
+    def prepare_migration(self, mac, hypervisor):
+        """ Make before break, install the rules between the peers of mac and the hypervisor it
+            moves to that don't conflict with the current ones. The switch over happens in
+            complete_migration once the VM shows up at the hypervisor """
+        current_hypervisor = self.get_hypervisor(mac)
+        if not current_hypervisor or hypervisor not in self.topology or hypervisor == current_hypervisor:
+            return False
+
+        self.cancel_migration(mac)
+        # The pre-installed rules get a cookie of their own, they belong to no pair until the switch over
+        migration = {
+            'hypervisor': hypervisor,
+            'rules': {},
+            'cookie': self.allocate_cookie(),
+            'started': time.time()
+        }
+
+        # The rules of the trees have the same matches wherever the host is, nothing can be done beforehand
+        if self.forwarding_mode == FORWARDING_PAIR:
+            batch = FlowBatch()
+
+            # Port of the VM at the hypervisor is unknown until it gets there
+            ports = { (hypervisor, mac): None }
+            for src, dst in self.installed_paths.pairs_of(mac):
+                current_rules = self.path_rules(src, dst, self.installed_paths[SrcDestMACPair(src, dst)], removing=True)
+                try:
+                    path = self.migrated_path(src, dst, mac, hypervisor)
+                    rules = self.path_rules(src, dst, path, ports)
+                except nx.NetworkXException:
+                    continue
+
+                # Without idle timeout, the VM can take a while to get there. Not tagged as edge rules
+                # until the switch over, the stats of the pair stay on its current rules
+                rules = { k: v for k, v in rules.items() if k not in current_rules }
+                self.install_rules(rules, batch, migration['cookie'], idle_timeout=0)
+                migration['rules'].update(rules)
+
+            self.send_batch(batch)
+
+        LOG.info('Migration of %s to %s prepared, %d rules pre-installed', mac, hypervisor, len(migration['rules']))
+        self.pending_migrations[mac] = migration
+        hub.spawn_after(MIGRATION_TIMEOUT, self.expire_migration, mac, migration)
+
+        return True
+
+    def is_edge_port(self, dpid, port):
+        """ Whether the port of the switch isn't connected to another switch """
+        for neighbour in self.topology[dpid]:
+            if self.topology.node[neighbour].get('type') == 'switch' and self.get_port(dpid, neighbour) == port:
+                return False
+
+        return True
+
+    def check_migration(self, mac, datapath, in_port):
+        migration = self.pending_migrations[mac]
+        dpid = dpid_to_str(datapath.id)
+
+        if dpid == migration['hypervisor'] and in_port != datapath.ofproto.OFPP_LOCAL and self.is_edge_port(dpid, in_port):
+            self.complete_migration(mac, in_port)
+
+    def complete_migration(self, mac, in_port):
+        """ The VM is at its new hypervisor, switch all its pairs over in one batch """
+        migration = self.pending_migrations.pop(mac)
+        hypervisor = migration['hypervisor']
+        current_hypervisor = self.get_hypervisor(mac)
+
+        batch = FlowBatch()
+        pairs = self.installed_paths.pairs_of(mac)
+
+        migrated_paths = {}
+        if self.forwarding_mode == FORWARDING_PAIR:
+            ports = { (hypervisor, mac): in_port }
+            installed_rules = set()
+
+            for src, dst in pairs:
+                current_path = self.installed_paths[SrcDestMACPair(src, dst)]
+                current_rules = self.path_rules(src, dst, current_path, removing=True)
+                try:
+                    path = self.migrated_path(src, dst, mac, hypervisor)
+                except nx.NetworkXException:
+                    path = None
+
+                rules = self.path_rules(src, dst, path, ports) if path else {}
+
+                # The migrated pair gets a new cookie, deleting the old rules can't be mistaken for it.
+                # Rules with the same match are overwritten in place, the others are added before the old ones go
+                cookie = self.allocate_cookie()
+                self.install_rules(rules, batch, cookie, edge=path[1] if path else None)
+                self.remove_rules([k for k in current_rules if k not in rules], batch)
+
+                installed_rules.update(rules)
+                migrated_paths[(src, dst)] = (path, cookie)
+
+            # Pre-installed for pairs that went away in the meantime
+            self.remove_rules([k for k in migration['rules'] if k not in installed_rules], batch)
+        else:
+            for src, dst in pairs:
+                self.uninstall_path(src, dst, self.installed_paths[SrcDestMACPair(src, dst)], batch)
+            self.uninstall_tree(mac, batch)
+
+        # Move the host in the topology
+        self.path_cache.invalidate_node(mac)
+        if current_hypervisor:
+            self.remove_link(current_hypervisor, mac)
+        self.add_link(NetworkLink(NetworkPort(mac, None), NetworkPort(hypervisor, in_port)))
+
+        if self.forwarding_mode == FORWARDING_PAIR:
+            for (src, dst), (path, cookie) in migrated_paths.items():
+                self.forget_path(src, dst)
+                if path:
+                    self.record_path(src, dst, path, path[::-1], cookie)
+        else:
+            for src, dst in pairs:
+                self.install_path(src, dst, batch)
+
+        def migrated_callback(completion):
+            self.migrations.append({
+                'mac': mac,
+                'from': current_hypervisor,
+                'to': hypervisor,
+                'pairs': len(pairs),
+                'prepared': migration['started'],
+                'duration': completion.duration
+            })
+            LOG.info('Migration of %s to %s switched over in %.3fs', mac, hypervisor, completion.duration)
+
+        self.send_batch(batch).add_done_callback(migrated_callback)
+        self.send_event_to_observers(EventHostMoved(mac, hypervisor))
+
+    def cancel_migration(self, mac):
+        migration = self.pending_migrations.pop(mac, None)
+        if migration and migration['rules']:
+            batch = FlowBatch()
+            self.remove_rules(migration['rules'], batch)
+            self.send_batch(batch)
+
+    def expire_migration(self, mac, migration):
+        """ The VM didn't show up in time, it is detached like without preparation so that it's
+            learned again wherever it ends up """
+        if self.pending_migrations.get(mac) is migration:
+            LOG.warning('Migration of %s to %s timed out', mac, migration['hypervisor'])
+            self.cancel_migration(mac)
+            self.migrate(mac)
 
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
+    @PACKET_IN_SECONDS.time()
     def _packet_in_handler(self, ev):
-            pkt = packet.Packet(array.array('B', ev.msg.data))
+            # Classify from the raw data, LLDP is handled by the switches app
+            ethertype, offset = classify_packet(ev.msg.data)
+            if ethertype != ether.ETH_TYPE_ARP and ethertype != ETH_TYPE_RARP and ethertype != ether.ETH_TYPE_IP:
+                PACKET_INS.inc('other')
+                return
 
-            # Ignore lldp packets
-            if pkt.get_protocol(lldp.lldp):
+            # Keep a single host from flooding the event loop
+            if not self.admit(ev.msg.data[6:12], time.time()):
+                PACKET_INS.inc('throttled')
                 return
 
-            # Parse the packets
-            ethernetp = pkt.get_protocol(ethernet.ethernet)
-            arpp = pkt.get_protocol(arp.arp)
-            ipp = pkt.get_protocol(ipv4.ipv4)
+            PACKET_INS.inc(PACKET_TYPES[ethertype])
 
             # Get datapath, protocol and protocol parser
-            # print dir(ev.msg)
             datapath = ev.msg.datapath
             ofproto = datapath.ofproto
             parser = datapath.ofproto_parser
@@ -283,15 +1553,39 @@ class Routing(app_manager.RyuApp):
             # In port changes depending on the parser
             in_port = ev.msg.match['in_port']
 
+            # IPv4 between hosts without a path
+            if ethertype == ether.ETH_TYPE_IP:
+                self.ipv4_packet_in(ev.msg, in_port)
+                return
+
+            # A VM announcing itself after a live migration
+            if ethertype == ETH_TYPE_RARP:
+                src_mac = mac.haddr_to_str(ev.msg.data[6:12])
+                if src_mac in self.pending_migrations:
+                    self.check_migration(src_mac, datapath, in_port)
+                return
+
+            arpp = parse_arp(ev.msg.data, offset)
+
             # We handle ARP packet
             if arpp:
                 # print 'got arp packet', arpp, hex(datapath.id)
 
+                if arpp.src_mac in self.pending_migrations:
+                    self.check_migration(arpp.src_mac, datapath, in_port)
+
                 # Got an host add it to the topology
                 self.add_host(datapath, in_port, arpp.src_mac, arpp.src_ip)
                 
                 # If the packet is an ARP request
                 if arpp.opcode == arp.ARP_REQUEST:
+                    if self.proxy_arp and self.answer_arp(datapath, in_port, arpp):
+                        return
+
+                    # Unknown target, don't flood the same request over and over
+                    if not self.should_flood_arp(datapath.id, arpp.dst_ip):
+                        return
+
                     # Get the payload if no_buffer is specified fixes bug in OVS
                     data = None
                     if ev.msg.buffer_id == ofproto.OFP_NO_BUFFER:
@@ -318,7 +1612,7 @@ class Routing(app_manager.RyuApp):
 
                     path = self.install_path(arpp.src_mac, arpp.dst_mac)
                     if path == None:
-                        print 'no path between source and destination'
+                        LOG.debug('no path between source and destination')
                         return
 
                     # Send the ARP_response
@@ -326,7 +1620,7 @@ class Routing(app_manager.RyuApp):
                         idx = path.index(dpid_to_str(datapath.id))
 
 
-                        dst_port = self.topology[dpid_to_str(datapath.id)][path[idx+1]]['obj'].getPortById(dpid_to_str(datapath.id)).port
+                        dst_port = self.get_port(dpid_to_str(datapath.id), path[idx+1])
                         data = None
                         if ev.msg.buffer_id == ofproto.OFP_NO_BUFFER:
                             data = ev.msg.data
@@ -340,21 +1634,417 @@ class Routing(app_manager.RyuApp):
                         )
                         datapath.send_msg(out)
                     else:
-                        print 'weird switch not on the path ... got packet from {} to {} at switch {} path is {}'.format(arpp.src_mac, arpp.dst_mac, dpid_to_str(datapath.id), path)
+                        LOG.warning('weird switch not on the path ... got packet from %s to %s at switch %s path is %s', arpp.src_mac, arpp.dst_mac, dpid_to_str(datapath.id), path)
+
+
+    def _snapshot_loop(self):
+        while True:
+            hub.sleep(SNAPSHOT_INTERVAL)
+            self.snapshot()
+
+    def snapshot(self):
+        # Half restored state would overwrite the pairs still waiting
+        if self.restoring:
+            return
+
+        try:
+            self.save_snapshot(self.snapshot_path)
+        except (IOError, OSError) as e:
+            LOG.warning('could not save the snapshot to %s: %s', self.snapshot_path, e)
+
+    def close(self):
+        if self.snapshot_path:
+            self.snapshot()
+
+    def save_snapshot(self, path):
+        """ Hosts and installed pairs, compressed JSON written to a temporary file then renamed
+            over the previous snapshot """
+        hosts = []
+        for mac, ip in self.mac_to_ip.items():
+            dpid = self.get_hypervisor(mac)
+            if dpid:
+                hosts.append([mac, ip, self.topology.node[mac]['type'], dpid, self.ports.get((dpid, mac))])
+
+        # And the ones waiting for their switch to come back
+        for dpid, detached in self.detached_hosts.items():
+            for mac, ip, host_type, port in detached:
+                if self.mac_to_ip.get(mac) == ip and not self.get_hypervisor(mac):
+                    hosts.append([mac, ip, host_type, dpid, port])
+
+        pairs = []
+        for key, (src, dst, forward, reverse) in self.installed_paths.entries.items():
+            pairs.append([src, dst, forward, reverse, self.pair_cookies.get(key)])
+
+        data = zlib.compress(json.dumps({
+            'version':         SNAPSHOT_VERSION,
+            'time':            time.time(),
+            'forwarding_mode': self.forwarding_mode,
+            'next_cookie':     self.next_cookie,
+            'hosts':           hosts,
+            'pairs':           pairs
+        }, separators=(',', ':')))
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+
+    def load_snapshot(self, path):
+        try:
+            with open(path, 'rb') as f:
+                snapshot = json.loads(zlib.decompress(f.read()))
+        except (IOError, ValueError, zlib.error) as e:
+            LOG.info('no snapshot restored from %s: %s', path, e)
+            return
+
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            LOG.warning('snapshot version %s not supported', snapshot.get('version'))
+            return
+
+        # Old cookies must not be given to new pairs
+        self.next_cookie = max(self.next_cookie, snapshot['next_cookie'])
+
+        hosts = {}
+        for mac, ip, host_type, dpid, port in snapshot['hosts']:
+            hosts.setdefault(dpid, []).append((mac, ip, host_type, port))
+
+        # Only the pair rules can be checked, the trees are built again with the traffic
+        pairs = []
+        if snapshot['forwarding_mode'] == FORWARDING_PAIR == self.forwarding_mode:
+            pairs = [pair for pair in snapshot['pairs'] if pair[4] is not None]
+
+        self.restoring = {
+            'hosts':    hosts,
+            'pairs':    pairs,
+            'reported': {},
+            'restored': 0,
+            'started':  time.time()
+        }
+        LOG.info('restoring %d hosts and %d pairs from %s', len(snapshot['hosts']), len(pairs), path)
+        hub.spawn_after(RESTORE_TIMEOUT, self.finish_restore, self.restoring)
+
+    def restore_switch(self, datapath):
+        """ Attach the hosts of the switch, its flows are checked once reported """
+        dpid = dpid_to_str(datapath.id)
+        for mac, ip, host_type, port in self.restoring['hosts'].pop(dpid, []):
+            if mac not in self.mac_to_ip:
+                self.attach_host(dpid, port, mac, ip, host_type)
+
+    def request_flows(self, datapath):
+        req = datapath.ofproto_parser.OFPFlowStatsRequest(datapath)
+        datapath.set_xid(req)
+        self.flow_requests[(datapath.id, req.xid)] = []
+        datapath.send_msg(req)
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def _flow_stats_reply_handler(self, ev):
+        # The stats of the other apps are theirs
+        key = (ev.msg.datapath.id, ev.msg.xid)
+        if key not in self.flow_requests:
+            return
+
+        self.flow_requests[key].extend(ev.msg.body)
+        if ev.msg.flags & ev.msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            return
+
+        self.flows_reported(ev.msg.datapath, self.flow_requests.pop(key))
+
+    def flows_reported(self, datapath, body):
+        dpid = dpid_to_str(datapath.id)
+        pair_rules, tree_rules = self.parse_rules(body)
+
+        # Restored pairs first, the reconciliation must not take their rules for stale ones
+        if self.restoring:
+            self.restoring['reported'][dpid] = pair_rules
+            self.restore_pairs()
+
+        self.reconciling[dpid] = {
+            'pairs':    dict(pair_rules),
+            'trees':    tree_rules,
+            'deadline': time.time() + RECONCILE_TIMEOUT
+        }
+        self.reconcile_switches()
+        hub.spawn_after(RECONCILE_TIMEOUT, self.reconcile_switches)
+
+    def parse_rules(self, body):
+        """ Forwarding rules in flow stats, the pair rules { (in_port, eth_src, eth_dst): (out_port, cookie) }
+            and the tree rules { eth_dst: out_port } """
+        pair_rules = {}
+        tree_rules = {}
+        for stat in body:
+            if stat.priority != PAIR_PRIORITY and stat.priority != TREE_PRIORITY:
+                continue
+
+            out_ports = [action.port for inst in stat.instructions for action in getattr(inst, 'actions', []) if hasattr(action, 'port')]
+            if len(out_ports) != 1:
+                continue
+
+            if stat.priority == PAIR_PRIORITY and 'in_port' in stat.match:
+                pair_rules[(stat.match['in_port'], stat.match.get('eth_src'), stat.match.get('eth_dst'))] = (out_ports[0], stat.cookie)
+            elif stat.priority == TREE_PRIORITY and 'eth_dst' in stat.match:
+                tree_rules[stat.match['eth_dst']] = out_ports[0]
+
+        return pair_rules, tree_rules
+
+    def pair_rules(self, src, dst, forward, reverse):
+        """ All the pair rules of a pair with these paths, { (dpid, in_port, eth_src, eth_dst): out_port } """
+        if self.forwarding_mode == FORWARDING_DESTINATION:
+            # Only at the source edge, the trees do the rest
+            edge_dpid = forward[1]
+            host_port = self.get_port(edge_dpid, src)
+            egress_port = self.get_port(edge_dpid, forward[2])
+            return_port = self.get_port(edge_dpid, reverse[-3])
+
+            return {
+                (edge_dpid, host_port, src, dst): egress_port,
+                (edge_dpid, return_port, dst, src): host_port
+            }
+
+        return self.path_rules(src, dst, forward)
+
+    def reconcile_switches(self):
+        """ Send the missing and stale rules of the reconnected switches in one batch """
+        batch = FlowBatch()
+        now = time.time()
+
+        for dpid, reported in list(self.reconciling.items()):
+            if dpid not in self.topology:
+                del self.reconciling[dpid]
+            elif self.reconcile_switch(dpid, reported, batch, now >= reported['deadline']):
+                del self.reconciling[dpid]
+
+        if len(batch):
+            self.send_batch(batch)
+
+    def reconcile_switch(self, dpid, reported, batch, expired):
+        """ Install the rules of the switch that are missing or different, once every path through it
+            could be checked (or expired) remove the ones no path needs. Returns whether it is done """
+        datapath = self.get_datapath(dpid)
+        parser = datapath.ofproto_parser
 
+        expected_pairs = set()
+        expected_trees = set()
+        # Pairs whose rules can't be told yet, their rules stay
+        unknown = set()
+
+        for key in list(self.switch_pairs.get(dpid, ())):
+            entry = self.installed_paths.entry(key)
+            if entry is None:
+                continue
+
+            src, dst, forward, reverse = entry
+            try:
+                rules = self.pair_rules(src, dst, forward, reverse)
+            except KeyError:
+                # A link of the path isn't back yet
+                unknown.add(key)
+                continue
+
+            cookie = self.pair_cookies[key]
+            edge_cookie = cookie | COOKIE_EDGE if dpid == forward[1] else cookie
+            idle = self.idle_directions.get(key, ()) if dpid == forward[1] else ()
+            for rule, out_port in rules.items():
+                # Edge rules that idled out come back with the traffic
+                if rule[0] != dpid or rule[2:] in idle:
+                    continue
+
+                expected_pairs.add(rule[1:])
+                if reported['pairs'].get(rule[1:]) != (out_port, edge_cookie):
+                    self.install_rules({ rule: out_port }, batch, cookie, edge=forward[1])
+                    reported['pairs'][rule[1:]] = (out_port, edge_cookie)
+
+        for dst, tree in self.installed_trees.items():
+            if dpid not in tree:
+                continue
+
+            expected_trees.add(dst)
+            out_port = self.ports.get((dpid, tree[dpid]))
+            if out_port is None:
+                continue
+
+            if reported['trees'].get(dst) != out_port:
+                self.add_flow(datapath, TREE_PRIORITY, parser.OFPMatch(eth_dst=dst), [parser.OFPActionOutput(out_port)], batch)
+                reported['trees'][dst] = out_port
+
+        # Rules pre-installed for migrations and those of pairs being restored aren't stale either
+        for migration in self.pending_migrations.values():
+            expected_pairs.update(rule[1:] for rule in migration['rules'] if rule[0] == dpid)
+        if self.restoring:
+            unknown.update(link_key(pair[0], pair[1]) for pair in self.restoring['pairs'])
+
+        if unknown and not expired:
+            return False
+
+        for in_port, eth_src, eth_dst in set(reported['pairs']) - expected_pairs:
+            if link_key(eth_src, eth_dst) not in unknown:
+                self.remove_flow(datapath, parser.OFPMatch(in_port=in_port, eth_src=eth_src, eth_dst=eth_dst), batch, priority=PAIR_PRIORITY)
+
+        for eth_dst in set(reported['trees']) - expected_trees:
+            self.remove_flow(datapath, parser.OFPMatch(eth_dst=eth_dst), batch, priority=TREE_PRIORITY)
+
+        return True
+
+    def restore_pairs(self):
+        """ Keep the restored pairs whose rules are all on the switches as they were, the others
+            are installed again in one batch """
+        reported = self.restoring['reported']
+        batch = FlowBatch()
+
+        pending = []
+        for pair in self.restoring['pairs']:
+            src, dst, forward, reverse, cookie = pair
+
+            if not all(switch_dpid in reported for switch_dpid in forward[1:-1]) or \
+               not all(self.topology.has_edge(forward[i], forward[i+1]) for i in range(len(forward)-1)):
+                pending.append(pair)
+                continue
+
+            # Installed with the traffic in the meantime
+            if SrcDestMACPair(src, dst) in self.installed_paths:
+                continue
+
+            rules = self.path_rules(src, dst, forward)
+            if all(reported[k[0]].get(k[1:]) == (v, cookie | COOKIE_EDGE if k[0] == forward[1] else cookie) for k, v in rules.items()):
+                self.record_path(src, dst, forward, reverse, cookie)
+                self.restoring['restored'] += 1
+            else:
+                self.install_path(src, dst, batch)
+
+        self.restoring['pairs'] = pending
+        if len(batch):
+            self.send_batch(batch)
+
+        if not pending and not self.restoring['hosts']:
+            self.finish_restore(self.restoring)
+
+    def finish_restore(self, restoring):
+        if self.restoring is not restoring:
+            return
+
+        LOG.info('restore done in %.3fs, %d pairs kept, %d hosts and %d pairs left out', time.time() - restoring['started'],
+            restoring['restored'], sum(len(h) for h in restoring['hosts'].values()), len(restoring['pairs']))
+        self.restoring = None
+
+    def is_host(self, node):
+        return self.topology.node.get(node, {}).get('type') in HOST_TYPES
+
+    def ipv4_packet_in(self, msg, in_port):
+        """ Install the path of the pair the packet belongs to, the packet is released along it
+            once the switches confirmed the rules """
+        received = time.time()
+
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        dpid = dpid_to_str(datapath.id)
+
+        dst_mac = mac.haddr_to_str(msg.data[0:6])
+        src_mac = mac.haddr_to_str(msg.data[6:12])
+
+        # Only unicast between known hosts can be routed
+        if not self.is_host(src_mac) or not self.is_host(dst_mac):
+            return
+
+        installed = SrcDestMACPair(src_mac, dst_mac) in self.installed_paths
+
+        batch = FlowBatch()
+        try:
+            path = self.install_path(src_mac, dst_mac, batch)
+        except nx.NetworkXException:
+            LOG.debug('no path between %s and %s', src_mac, dst_mac)
+            return
+
+        # The edge rule of this direction idled out while the other direction kept the pair
+        if installed and self.revive_direction(src_mac, dst_mac, batch):
+            installed = False
+
+        # Not on the path (ECMP, packets in flight after an eviction), the rules go out without the packet
+        if dpid not in path[1:-1]:
+            if not installed:
+                self.send_batch(batch)
+            return
+        out_port = self.get_port(dpid, path[path.index(dpid)+1])
+
+        def release(completion=None):
+            data = None
+            if msg.buffer_id == ofproto.OFP_NO_BUFFER:
+                data = msg.data
+
+            out = parser.OFPPacketOut(
+                datapath=datapath,
+                buffer_id=msg.buffer_id,
+                in_port=in_port,
+                actions=[parser.OFPActionOutput(out_port)],
+                data=data
+            )
+            datapath.send_msg(out)
+
+            if completion:
+                self.first_packet_delays.append({
+                    'src': src_mac,
+                    'dst': dst_mac,
+                    'duration': time.time() - received
+                })
+
+        # The path may already be there, packets in flight while it was being installed
+        if installed:
+            release()
+        else:
+            self.send_batch(batch).add_done_callback(release)
+
+    def answer_arp(self, datapath, in_port, arpp):
+        """ Reply to an ARP request on behalf of a known host, the path between the
+            two hosts is installed before the reply so the first packet has a route """
+        target_mac = self.ip_to_mac.get(arpp.dst_ip)
+
+        # Leave probes (no source address) and gratuitous ARPs to the hosts
+        if not target_mac or target_mac == arpp.src_mac or arpp.src_ip == '0.0.0.0':
+            return False
+
+        if arpp.src_mac not in self.topology or target_mac not in self.topology:
+            return False
+
+        try:
+            self.install_path(arpp.src_mac, target_mac)
+        except nx.NetworkXException:
+            return False
+
+        self.send_arp_reply(datapath, in_port, target_mac, arpp.dst_ip, arpp.src_mac, arpp.src_ip)
+        return True
+
+    def should_flood_arp(self, dpid, ip):
+        now = time.time()
+        key = (dpid, ip)
+
+        if now - self.arp_floods.get(key, 0) < ARP_FLOOD_INTERVAL:
+            return False
+
+        # Oldest floods first, they are forgotten so the table doesn't grow forever
+        self.arp_floods.pop(key, None)
+        self.arp_floods[key] = now
+        if len(self.arp_floods) > MAX_TRACKED_SOURCES:
+            self.arp_floods.popitem(last=False)
+
+        return True
+
+    def send_arp_reply(self, datapath, port, src_mac, src_ip, dst_mac, dst_ip):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
 
-    def discover_host(self, ip):
         e = ethernet.ethernet(
-            dst='ff:ff:ff:ff:ff:ff',
-            src=CONTROLLER_MAC,
+            dst=dst_mac,
+            src=src_mac,
             ethertype=ether.ETH_TYPE_ARP
         )
 
         a = arp.arp(
-            src_ip='0.0.0.0',
-            src_mac=CONTROLLER_MAC,
-            dst_ip=ip,
-            dst_mac='ff:ff:ff:ff:ff:ff'
+            opcode=arp.ARP_REPLY,
+            src_mac=src_mac,
+            src_ip=src_ip,
+            dst_mac=dst_mac,
+            dst_ip=dst_ip
         )
 
         p = packet.Packet()
@@ -362,21 +2052,34 @@ class Routing(app_manager.RyuApp):
         p.add_protocol(a)
         p.serialize()
 
-        switch = None
+        out = parser.OFPPacketOut(
+            datapath=datapath,
+            buffer_id=ofproto.OFP_NO_BUFFER,
+            in_port=ofproto.OFPP_CONTROLLER,
+            actions=[parser.OFPActionOutput(port)],
+            data=p.data
+        )
+        datapath.send_msg(out)
+
+    def edge_switches(self):
+        """ [(datapath, ports)] of the switches with ports that aren't connected to another switch """
+        edges = []
         for n,d in self.topology.nodes_iter(data=True):
-            if d.get('type') == 'switch':
-                switch = d.get('obj')
+            if d.get('type') != 'switch':
+                continue
 
-        if switch:
-            print 'discovering', ip
-            datapath = switch.dp
-            ofproto = datapath.ofproto
-            parser = datapath.ofproto_parser
-            out = parser.OFPPacketOut(
-                datapath=datapath,
-                buffer_id=ofproto.OFP_NO_BUFFER,
-                in_port=ofproto.OFPP_CONTROLLER,
-                actions=[parser.OFPActionOutput(ofproto.OFPP_FLOOD)],
-                data=p.data
-            )
-            datapath.send_msg(out)
\ No newline at end of file
+            switch = d['obj']
+            fabric_ports = set(self.ports[(n, neighbour)] for neighbour in self.topology[n] if self.topology.node[neighbour].get('type') == 'switch')
+            ports = [p.port_no for p in switch.ports if p.port_no not in fabric_ports]
+
+            # The hypervisors are on the local port
+            edges.append((switch.dp, ports + [switch.dp.ofproto.OFPP_LOCAL]))
+
+        return edges
+
+    def discover_hosts(self, ips):
+        """ Probe the IPs, returns a DiscoveryRequest completing once they are all found or given up on """
+        return self.discovery.discover(ips)
+
+    def discover_host(self, ip):
+        return self.discover_hosts([ip])
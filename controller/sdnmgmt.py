@@ -4,20 +4,51 @@ from ryu.base import app_manager
 from ryu.controller.handler import set_ev_cls
 from ryu.controller.handler import MAIN_DISPATCHER
 from ryu.topology.api import get_all_switch, get_switch, get_link
+from ryu.lib import hub
 
 import json
 from webob import Response, exc
 from ryu.app.wsgi import ControllerBase, WSGIApplication, route
 
 from contextlib import closing
+from collections import deque
 
 from ryu.sdnmgmt import routing
+from ryu.sdnmgmt.history import RateHistory
+from ryu.sdnmgmt.sflow import SFlowCollector
+from ryu.sdnmgmt.metrics import REGISTRY
 import networkx as nx
 
+import io
 import logging
+import random
+import time
+
+import numpy as np
 
 LOG = logging.getLogger(__name__)
 
+STATS_REPLY_SECONDS = REGISTRY.histogram('sdnscore_stats_reply_seconds', 'Time spent processing a complete stats reply', ('type',))
+REST_SECONDS = REGISTRY.histogram('sdnscore_rest_seconds', 'Time spent in the REST handlers', ('action',))
+
+# Copied from the state of the apps when scraped
+INSTALLED_PAIRS = REGISTRY.gauge('sdnscore_installed_pairs', 'Pairs of hosts with an installed path')
+PATH_CACHE = REGISTRY.gauge('sdnscore_path_cache_lookups', 'Path cache lookups by result', ('result',))
+ADMISSION = REGISTRY.gauge('sdnscore_admitted_packet_ins', 'Packet-ins by admission result', ('result',))
+STATS_EPOCH = REGISTRY.gauge('sdnscore_stats_epoch', 'Last complete stats epoch')
+STATS_EPOCH_SECONDS = REGISTRY.gauge('sdnscore_stats_epoch_seconds', 'Time the last complete stats epoch took')
+
+# Seconds between two rounds of flow stats requests, randomised by +/- STATS_JITTER
+STATS_INTERVAL = 1.0
+STATS_JITTER = 0.1
+# UDP port to measure the pairs from sFlow samples instead of flow stats, None to poll the flows
+SFLOW_PORT = None
+
+# Epochs of changes kept for the subscribers, older ones get the whole state
+SUBSCRIPTION_BACKLOG = 64
+# Seconds without stats before the history of a pair is forgotten
+HISTORY_EXPIRY = 600
+
 
 class MACPair(object):
     def __init__(self, mac1, mac2):
@@ -43,6 +74,41 @@ class MACPair(object):
         return self.__dict__
 
 
+class StatsEpoch(object):
+    """ One round of flow stats requests, complete once every switch answered or it expired """
+    def __init__(self, number, dpids):
+        self.number = number
+        self.pending = set(dpids)
+        self.missing = []
+        self.started = time.time()
+        self.completed = None
+
+    def done(self):
+        return self.completed is not None
+
+    def confirm(self, dpid):
+        self.pending.discard(dpid)
+        if not self.pending and not self.done():
+            self.completed = time.time()
+            return True
+
+        return False
+
+    def expire(self):
+        """ Give up on the switches that didn't answer """
+        self.missing = sorted(self.pending)
+        self.pending.clear()
+        return self.confirm(None)
+
+    def to_dict(self):
+        return {
+            'epoch':    self.number,
+            'started':  self.started,
+            'duration': self.completed - self.started if self.done() else None,
+            'missing':  self.missing
+        }
+
+
 class SDNMgmt(app_manager.RyuApp):
     _CONTEXTS = {
         'wsgi': WSGIApplication,
@@ -59,41 +125,278 @@ class SDNMgmt(app_manager.RyuApp):
 
         self.stats = {}
 
+        # Stats of the last complete epoch, consumers only ever see whole rounds
+        self.snapshot = {}
+        self.epoch = None
+        self.last_epoch = None
+        self.epoch_done = hub.Event()
+        # (dpid, xid) -> [epoch, stats received so far]
+        self.outstanding = {}
+        # (dpid, port) -> (tx bytes, duration) of the last port stats
+        self.port_counters = {}
+
+        # Traffic rates of the last rounds of every pair
+        self.history = RateHistory()
+        self.sflow = SFlowCollector(SFLOW_PORT) if SFLOW_PORT else None
+        # rate field -> (epoch, encoded traffic matrix)
+        self.matrix_cache = {}
+
+        # (epoch, changes) for the subscribers and the state they add up to
+        self.updates = deque(maxlen=SUBSCRIPTION_BACKLOG)
+        self.published = { 'rates': {}, 'placement': {}, 'topology_version': None }
+
+        self.stats_interval = STATS_INTERVAL
+        self.stats_thread = hub.spawn(self._stats_loop)
+
+    def _stats_loop(self):
+        while True:
+            self.start_epoch()
+            # Jitter so the polls don't line up with anything else periodic
+            hub.sleep(self.stats_interval * random.uniform(1 - STATS_JITTER, 1 + STATS_JITTER))
+
+    def start_epoch(self):
+        """ Query the flows of the hypervisor edge switches and the ports of all of them, the
+            previous epoch expires if still incomplete """
+        if self.epoch and not self.epoch.done():
+            LOG.debug('stats epoch %d expired, missing %s', self.epoch.number, self.epoch.pending)
+            for key in [k for k, v in self.outstanding.items() if v[0] is self.epoch]:
+                del self.outstanding[key]
+
+            if self.epoch.expire():
+                self.complete_epoch(self.epoch)
+
+        self.history.expire(time.time() - HISTORY_EXPIRY)
+
+        # The samples since the previous epoch replace the flow stats
+        datapaths = []
+        if self.sflow:
+            self.update_sampled_stats(*self.sflow.rates(time.time()))
+        else:
+            for dpid in set(self.routing.hypervisor_mac_to_dpid.values()):
+                if dpid in self.routing.topology:
+                    datapaths.append(self.routing.get_datapath(dpid))
+
+        switches = [self.routing.get_datapath(n) for n, d in self.routing.topology.nodes_iter(data=True) if d.get('type') == 'switch']
+
+        number = self.epoch.number + 1 if self.epoch else 1
+        epoch = self.epoch = StatsEpoch(number, [(datapath.id, 'flow') for datapath in datapaths] + [(datapath.id, 'port') for datapath in switches])
+        for datapath in datapaths:
+            self.send_flow_stats_request(datapath, epoch)
+        for datapath in switches:
+            self.send_port_stats_request(datapath, epoch)
+
+        if not datapaths and not switches and epoch.confirm(None):
+            self.complete_epoch(epoch)
+
+        return epoch
+
+    def complete_epoch(self, epoch):
+        self.snapshot = { k: dict(v) for k, v in self.stats.items() }
+        self.last_epoch = epoch
+        self.publish(epoch)
+
+        # Wake up everyone waiting and start over for the next one
+        event, self.epoch_done = self.epoch_done, hub.Event()
+        event.set()
+
+    def metrics(self):
+        """ Prometheus text of all the metrics, the gauges are updated first """
+        INSTALLED_PAIRS.set(len(self.routing.installed_paths))
+        PATH_CACHE.set(self.routing.path_cache.hits, 'hit')
+        PATH_CACHE.set(self.routing.path_cache.misses, 'miss')
+        ADMISSION.set(self.routing.admission['accepted'], 'accepted')
+        ADMISSION.set(self.routing.admission['throttled'], 'throttled')
+
+        if self.last_epoch:
+            STATS_EPOCH.set(self.last_epoch.number)
+            STATS_EPOCH_SECONDS.set(self.last_epoch.completed - self.last_epoch.started)
 
-    def send_flow_stats_request(self, datapath):
+        return REGISTRY.render()
+
+    def placement(self):
+        """ VM -> dpid of its hypervisor """
+        res = {}
+        for n,d in self.routing.topology.nodes_iter(data=True):
+            if d.get('type') == 'vm':
+                res[n] = self.routing.get_hypervisor(n)
+
+        return res
+
+    def publish(self, epoch):
+        """ Record what changed since the previous epoch, rates are [mac1, mac2, rate, ewma] and
+            None for the pairs and VMs that went away """
+        rates = { str(k): [k.mac1, k.mac2, v['traffic_rate'], v['ewma_rate']] for k, v in self.snapshot.items() }
+        placement = self.placement()
+        topology_version = self.routing.topology_version
+
+        changes = {}
+        for name, current in (('rates', rates), ('placement', placement)):
+            previous = self.published[name]
+            delta = { k: v for k, v in current.items() if previous.get(k) != v }
+            delta.update({ k: None for k in previous if k not in current })
+            changes[name] = delta
+
+        if topology_version != self.published['topology_version']:
+            changes['topology_version'] = topology_version
+
+        self.updates.append((epoch.number, changes))
+        self.published = { 'rates': rates, 'placement': placement, 'topology_version': topology_version }
+
+    def updates_since(self, since):
+        """ Changes of the epochs after since merged together, everything if they are not all kept """
+        epoch = self.last_epoch.number if self.last_epoch else 0
+        if not self.updates or since < self.updates[0][0] - 1 or since > epoch:
+            res = dict(self.published)
+            res.update({ 'epoch': epoch, 'full': True })
+            return res
+
+        res = { 'epoch': epoch, 'full': False, 'rates': {}, 'placement': {} }
+        for number, changes in self.updates:
+            if number > since:
+                res['rates'].update(changes['rates'])
+                res['placement'].update(changes['placement'])
+                if 'topology_version' in changes:
+                    res['topology_version'] = changes['topology_version']
+
+        return res
+
+    def wait_epoch(self, since, timeout):
+        """ Wait until an epoch after since is complete, returns the last complete one """
+        deadline = time.time() + timeout
+        while self.last_epoch is None or self.last_epoch.number <= since:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.epoch_done.wait(remaining)
+
+        return self.last_epoch
+
+    def traffic_matrix(self, field='traffic_rate'):
+        """ Symmetric float32 rate matrix of the last complete epoch with the MACs of its rows,
+            as an npz archive. Encoded once per epoch """
+        epoch = self.last_epoch.number if self.last_epoch else 0
+        cached = self.matrix_cache.get(field)
+        if cached and cached[0] == epoch:
+            return epoch, cached[1]
+
+        macs = sorted(set(k.mac1 for k in self.snapshot) | set(k.mac2 for k in self.snapshot))
+        index = { m: i for i, m in enumerate(macs) }
+
+        rates = np.zeros((len(macs), len(macs)), dtype=np.float32)
+        for k, v in self.snapshot.items():
+            i = index[k.mac1]
+            j = index[k.mac2]
+            rates[i, j] = rates[j, i] = v[field]
+
+        buf = io.BytesIO()
+        np.savez(buf, macs=np.array(macs, dtype='S17'), rates=rates)
+        self.matrix_cache[field] = (epoch, buf.getvalue())
+
+        return epoch, self.matrix_cache[field][1]
+
+    def send_flow_stats_request(self, datapath, epoch):
         ofp = datapath.ofproto
         ofp_parser = datapath.ofproto_parser
 
-        req = ofp_parser.OFPFlowStatsRequest(datapath)
+        # Only the pair rules the switch is the edge of
+        req = ofp_parser.OFPFlowStatsRequest(datapath, cookie=routing.COOKIE_EDGE, cookie_mask=routing.COOKIE_EDGE, match=ofp_parser.OFPMatch())
+        self.send_stats_request(datapath, req, epoch)
+
+    def send_port_stats_request(self, datapath, epoch):
+        req = datapath.ofproto_parser.OFPPortStatsRequest(datapath, 0, datapath.ofproto.OFPP_ANY)
+        self.send_stats_request(datapath, req, epoch)
+
+    def send_stats_request(self, datapath, req, epoch):
+        datapath.set_xid(req)
+        self.outstanding[(datapath.id, req.xid)] = [epoch, []]
         datapath.send_msg(req)
 
+    def collect_reply(self, msg):
+        """ Epoch and whole body of the request once its last part arrived, None until then """
+        key = (msg.datapath.id, msg.xid)
+
+        # Replies of expired epochs are dropped
+        request = self.outstanding.get(key)
+        if request is None:
+            return None
+
+        # Large tables come in several parts, only the last one is without the more flag
+        request[1].extend(msg.body)
+        if msg.flags & msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            return None
+
+        del self.outstanding[key]
+        return request
+
     @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
     def flow_stats_reply_handler(self, ev):
+        request = self.collect_reply(ev.msg)
+        if request is None:
+            return
+
+        dpid = ev.msg.datapath.id
+        start = time.time()
+        self.update_switch_stats(dpid, request[1])
+        STATS_REPLY_SECONDS.observe(time.time() - start, 'flow')
+
+        epoch = request[0]
+        if epoch.confirm((dpid, 'flow')):
+            self.complete_epoch(epoch)
+
+    @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
+    def port_stats_reply_handler(self, ev):
+        request = self.collect_reply(ev.msg)
+        if request is None:
+            return
+
+        start = time.time()
+        self.update_port_stats(ev.msg.datapath, request[1])
+        STATS_REPLY_SECONDS.observe(time.time() - start, 'port')
+
+        epoch = request[0]
+        if epoch.confirm((ev.msg.datapath.id, 'port')):
+            self.complete_epoch(epoch)
+
+    def update_port_stats(self, datapath, body):
+        """ Transmit rate of every port, the routing turns them into link utilisations """
+        for stat in body:
+            if stat.port_no > datapath.ofproto.OFPP_MAX:
+                continue
+
+            key = (datapath.id, stat.port_no)
+            duration = stat.duration_sec + stat.duration_nsec / 10.0**9
+            last = self.port_counters.get(key)
+            self.port_counters[key] = (stat.tx_bytes, duration)
+
+            # The port was reset in between
+            if last is None or duration <= last[1] or stat.tx_bytes < last[0]:
+                continue
+
+            self.routing.update_port_rate(datapath.id, stat.port_no, (stat.tx_bytes - last[0]) / (duration - last[1]))
+
+    def update_switch_stats(self, dpid, body):
+        now = time.time()
         switch_stats = {}
-        # print 'FLOW STAT REPLY'
-
-        # Iterate over all the flow stats
-        # print ev.msg.body
-        for stat in ev.msg.body:
-            eth_src = stat.match.get('eth_src')
-            eth_dst = stat.match.get('eth_dst')
-
-            # If flow contains both source and destination
-            if eth_src and eth_dst:
-                key = MACPair(eth_src, eth_dst)
 
+        # The cookie gives the pair, rules of pairs the routing forgot are on their way out
+        cookie_pairs = self.routing.cookie_pairs
+        for stat in body:
+            pair = cookie_pairs.get(stat.cookie & routing.COOKIE_PAIR_MASK)
+            if pair:
                 # list of matching flows, should only be two
-                switch_stats.setdefault(key, []).append(stat)
+                switch_stats.setdefault(pair, []).append(stat)
 
         #
-        for key,v in switch_stats.items():
-            if len(v) != 2:
+        for pair,v in switch_stats.items():
+            key = MACPair(*pair)
+            # One of the directions may have idled out on its own
+            if len(v) > 2:
                 LOG.debug('unexpected number of flow stats, should only get forward and return path')
-                return
+                continue
 
-            # Get byte_count both ways and duration in seconds
-            byte_count = v[0].byte_count + v[1].byte_count
-            duration = v[0].duration_sec + v[0].duration_nsec / 10.0**9
+            # Get byte_count both ways and duration in seconds, of the oldest rule
+            byte_count = sum(stat.byte_count for stat in v)
+            duration = max(stat.duration_sec + stat.duration_nsec / 10.0**9 for stat in v)
 
             last_byte_count = 0
             last_duration = 0
@@ -109,34 +412,70 @@ class SDNMgmt(app_manager.RyuApp):
                     # LOG.debug('counter overflowed')
                     # (byte_count + 2**64) - last_byte_count
 
-                # If previous flow duration is larger then the flow timeout in between the measurements
-                # if last_duration > duration:
-                    # print 'timedout', last_duration, duration
-                    # last_duration = 0
-                    # last_byte_count = 0
+                # If previous flow duration is larger then the flow timed out and was reinstalled in between the measurements,
+                # fewer bytes one of the directions expired
+                if last_duration > duration or last_byte_count > byte_count:
+                    last_duration = 0
+                    last_byte_count = 0
 
-                # Ignore if this switch is not responsible for this flow
-                if self.stats[key]['dpid'] != ev.msg.datapath.id:
-                    LOG.debug('switch {} is not responsible for this flow {} is'.format(ev.msg.datapath.id, self.stats[key]['dpid']))
-                    continue
+                # The edge of the pair moved, the counters are new
+                if self.stats[key]['dpid'] != dpid:
+                    LOG.debug('switch %s is now responsible for flow %s, was %s', dpid, key, self.stats[key]['dpid'])
+                    last_duration = 0
+                    last_byte_count = 0
 
             # Calculate traffic_rate over time period
             delta_bytes = byte_count - last_byte_count
             delta_duration = duration - last_duration
-            traffic_rate = delta_bytes / delta_duration
 
             # print v[0].hard_timeout, v[0].idle_timeout
             # print 'delta byte count', str(key), last_byte_count, byte_count, delta_bytes, last_duration, duration, delta_duration
 
-            # Save the stats
-            self.stats[key] = {
-                'delta_bytes':     delta_bytes,
-                'delta_duration':  delta_duration,
-                'traffic_rate':    traffic_rate,
-                'dpid':            ev.msg.datapath.id,
-                'last_byte_count': byte_count,
-                'last_duration':   duration,
-            }
+            self.save_stats(key, now, dpid, delta_bytes, delta_duration, byte_count, duration)
+
+    def update_sampled_stats(self, rates, duration):
+        """ Pair rates estimated by the sFlow collector, the pairs without samples are idle """
+        if duration <= 0:
+            return
+
+        now = time.time()
+        for key in set(self.stats) | set(MACPair(*pair) for pair in rates):
+            rate = rates.get((key.mac1, key.mac2), 0)
+
+            # Idle for a second round, gone
+            if rate == 0 and self.stats.get(key, {}).get('traffic_rate') == 0:
+                del self.stats[key]
+                continue
+
+            self.save_stats(key, now, None, rate * duration, duration, 0, 0)
+
+    def save_stats(self, key, now, dpid, delta_bytes, delta_duration, byte_count, duration):
+        traffic_rate = delta_bytes / delta_duration
+
+        self.history.add(key, now, traffic_rate)
+        summary = self.history.summary(key)
+
+        # Save the stats
+        self.stats[key] = {
+            'delta_bytes':     delta_bytes,
+            'delta_duration':  delta_duration,
+            'traffic_rate':    traffic_rate,
+            'ewma_rate':       summary['ewma'],
+            'peak_rate':       summary['peak'],
+            'dpid':            dpid,
+            'last_byte_count': byte_count,
+            'last_duration':   duration,
+        }
+
+        # Keep the link loads of the routing up to date for the path selection
+        self.routing.update_pair_rate(key.mac1, key.mac2, traffic_rate)
+
+
+    @set_ev_cls(routing.EventHostMoved)
+    def host_moved_handler(self, ev):
+        # The pair counters of the host are on other switches now, start over
+        for key in [k for k in self.stats if ev.mac in (k.mac1, k.mac2)]:
+            del self.stats[key]
 
 
 class SDNMgmtController(ControllerBase):
@@ -144,33 +483,97 @@ class SDNMgmtController(ControllerBase):
         super(SDNMgmtController, self).__init__(req, link, data, **config)
         self.topology_api_app = data['topology_api_app']
 
+    def __call__(self, req):
+        start = time.time()
+        try:
+            return super(SDNMgmtController, self).__call__(req)
+        finally:
+            REST_SECONDS.observe(time.time() - start, req.urlvars.get('action', 'index'))
+
+    @route('sdnmgmt', '/v1.0/sdnmgmt/metrics', methods=['GET'])
+    def metrics(self, req, **kwargs):
+        return Response(content_type='text/plain', body=self.topology_api_app.metrics())
+
     @route('sdnmgmt', '/v1.0/sdnmgmt/query', methods=['POST'])
     def query_flowstats(self, req, **kwargs):
-        for dpid in self.topology_api_app.routing.hypervisor_mac_to_dpid.values():
-            # print 'querying', dpid
-            switch = self.topology_api_app.routing.topology.node[dpid]['obj']
-            self.topology_api_app.send_flow_stats_request(switch.dp)
-
-        return Response(content_type='application/json', body='')
+        # The stats are polled anyway, this only starts the next epoch early
+        epoch = self.topology_api_app.start_epoch()
+        return Response(content_type='application/json', body=json.dumps({ 'epoch': epoch.number }))
 
     @route('sdnmgmt', '/v1.0/sdnmgmt/view', methods=['GET'])
     def view_flowstats(self, req, **kwargs):
+        # Optionally wait for an epoch newer than since
+        since = req.params.get('since')
+        if since:
+            self.topology_api_app.wait_epoch(int(since), float(req.params.get('wait', 10)))
+
         res = {}
-        for k,v in self.topology_api_app.stats.items():
+        for k,v in self.topology_api_app.snapshot.items():
             key = str(k)
-            res[key] = v
+            res[key] = dict(v)
             res[key]['endpoints'] = k.to_dict()
 
+        last_epoch = self.topology_api_app.last_epoch
+        response = Response(content_type='application/json', body=json.dumps(res))
+        response.headers['X-Stats-Epoch'] = str(last_epoch.number if last_epoch else 0)
+        return response
+
+    @route('sdnmgmt', '/v1.0/sdnmgmt/trafficmatrix', methods=['GET'])
+    def traffic_matrix(self, req, **kwargs):
+        # Same waiting as the view
+        since = req.params.get('since')
+        if since:
+            self.topology_api_app.wait_epoch(int(since), float(req.params.get('wait', 10)))
+
+        field = 'ewma_rate' if req.params.get('rate') == 'ewma' else 'traffic_rate'
+        epoch, body = self.topology_api_app.traffic_matrix(field)
+
+        response = Response(content_type='application/octet-stream', body=body)
+        response.headers['X-Stats-Epoch'] = str(epoch)
+        return response
+
+    @route('sdnmgmt', '/v1.0/sdnmgmt/sflow', methods=['GET'])
+    def sflow(self, req, **kwargs):
+        collector = self.topology_api_app.sflow
+        return Response(content_type='application/json', body=json.dumps(collector.to_dict() if collector else None))
+
+    @route('sdnmgmt', '/v1.0/sdnmgmt/history', methods=['GET'])
+    def history(self, req, **kwargs):
+        history = self.topology_api_app.history
+        src = req.params.get('src')
+        dst = req.params.get('dst')
+
+        # Samples of one pair, or the summary of all of them
+        if src and dst:
+            key = MACPair(src, dst)
+            if key not in history:
+                return exc.HTTPNotFound()
+
+            res = history.summary(key)
+            res['history'] = history.samples(key)
+        elif src or dst:
+            return exc.HTTPBadRequest()
+        else:
+            res = { str(k): history.summary(k) for k in history.rows }
+
         return Response(content_type='application/json', body=json.dumps(res))
 
+    @route('sdnmgmt', '/v1.0/sdnmgmt/epoch', methods=['GET'])
+    def stats_epoch(self, req, **kwargs):
+        last_epoch = self.topology_api_app.last_epoch
+        return Response(content_type='application/json', body=json.dumps(last_epoch.to_dict() if last_epoch else None))
+
     @route('sdnmgmt', '/v1.0/sdnmgmt/placement', methods=['GET'])
     def placement(self, req, **kwargs):
-        res = {}
-        for n,d in self.topology_api_app.routing.topology.nodes_iter(data=True):
-            if d.get('type') == 'vm':
-                res[n] = self.topology_api_app.routing.get_hypervisor(n)
+        return Response(content_type='application/json', body=json.dumps(self.topology_api_app.placement()))
 
-        return Response(content_type='application/json', body=json.dumps(res))
+    @route('sdnmgmt', '/v1.0/sdnmgmt/subscribe', methods=['GET'])
+    def subscribe(self, req, **kwargs):
+        # Long poll, returns once an epoch after since completed with what changed since
+        since = int(req.params.get('since', 0))
+        self.topology_api_app.wait_epoch(since, float(req.params.get('wait', 10)))
+
+        return Response(content_type='application/json', body=json.dumps(self.topology_api_app.updates_since(since)))
 
     @route('sdnmgmt', '/v1.0/sdnmgmt/macs', methods=['GET'])
     def view_macs(self, req, **kwargs):
@@ -182,15 +585,62 @@ class SDNMgmtController(ControllerBase):
         src = req.params.get('src')
         dst = req.params.get('dst')
 
+        weighted = bool(req.params.get('weighted'))
+
         if not src and not dst:
             return exc.HTTPBadRequest()
         elif src and not dst:
-            body = json.dumps({ hypervisor: self.topology_api_app.routing.calculate_path_cost(src, hypervisor) for hypervisor in self.topology_api_app.routing.hypervisor_mac_to_dpid.values() })
+            body = json.dumps({ hypervisor: self.topology_api_app.routing.calculate_path_cost(src, hypervisor, weighted) for hypervisor in self.topology_api_app.routing.hypervisor_mac_to_dpid.values() })
             return Response(content_type='application/json', body=body)
         else:
-            body = json.dumps(self.topology_api_app.routing.calculate_path_cost(src, dst))
+            body = json.dumps(self.topology_api_app.routing.calculate_path_cost(src, dst, weighted))
             return Response(content_type='application/json', body=body)
 
+    @route('sdnmgmt', '/v1.0/sdnmgmt/costmatrix', methods=['GET'])
+    def cost_matrix(self, req, **kwargs):
+        version, matrix = self.topology_api_app.routing.cost_matrix(bool(req.params.get('weighted')))
+
+        # Nothing changed since the caller's copy
+        etag = '"{}"'.format(version)
+        if req.headers.get('If-None-Match') == etag:
+            response = Response(status=304)
+        else:
+            response = Response(content_type='application/json', body=json.dumps({ 'version': version, 'costs': matrix }))
+
+        response.headers['ETag'] = etag
+        return response
+
+    @route('sdnmgmt', '/v1.0/sdnmgmt/pathcache', methods=['GET'])
+    def path_cache(self, req, **kwargs):
+        return Response(content_type='application/json', body=json.dumps(self.topology_api_app.routing.path_cache.to_dict()))
+
+    @route('sdnmgmt', '/v1.0/sdnmgmt/setuptimes', methods=['GET'])
+    def path_setup_times(self, req, **kwargs):
+        return Response(content_type='application/json', body=json.dumps(list(self.topology_api_app.routing.path_setup_times)))
+
+    @route('sdnmgmt', '/v1.0/sdnmgmt/firstpacket', methods=['GET'])
+    def first_packet_delays(self, req, **kwargs):
+        return Response(content_type='application/json', body=json.dumps(list(self.topology_api_app.routing.first_packet_delays)))
+
+    @route('sdnmgmt', '/v1.0/sdnmgmt/repairs', methods=['GET'])
+    def link_repairs(self, req, **kwargs):
+        return Response(content_type='application/json', body=json.dumps(list(self.topology_api_app.routing.link_repairs)))
+
+    @route('sdnmgmt', '/v1.0/sdnmgmt/admission', methods=['GET'])
+    def admission(self, req, **kwargs):
+        return Response(content_type='application/json', body=json.dumps(self.topology_api_app.routing.admission))
+
+    @route('sdnmgmt', '/v1.0/sdnmgmt/paths', methods=['GET'])
+    def installed_paths(self, req, **kwargs):
+        mac = req.params.get('mac')
+
+        if not mac:
+            return exc.HTTPBadRequest()
+
+        installed_paths = self.topology_api_app.routing.installed_paths
+        res = { peer: installed_paths[routing.SrcDestMACPair(mac, peer)] for peer in installed_paths.peers(mac) }
+        return Response(content_type='application/json', body=json.dumps(res))
+
     @route('sdnmgmt', '/v1.0/sdnmgmt/discovery', methods=['GET'])
     def discovery(self, req, **kwargs):
         dst = req.params.get('dst')
@@ -198,8 +648,14 @@ class SDNMgmtController(ControllerBase):
         if not dst:
             return exc.HTTPBadRequest()
 
-        for d in dst.split(','):
-            self.topology_api_app.routing.discover_host(d)
+        request = self.topology_api_app.routing.discover_hosts(dst.split(','))
+
+        # Optionally wait for the hosts to answer instead of polling
+        wait = req.params.get('wait')
+        if wait:
+            request.wait(float(wait))
+
+        return Response(content_type='application/json', body=json.dumps(request.to_dict()))
 
     @route('sdnmgmt', '/v1.0/sdnmgmt/hypervisors', methods=['GET'])
     def hypervisors(self, req, **kwargs):
@@ -212,6 +668,9 @@ class SDNMgmtController(ControllerBase):
 
         if src and dst:
             key = routing.SrcDestMACPair(src, dst)
+            if key not in self.topology_api_app.routing.installed_paths:
+                return exc.HTTPNotFound()
+
             path = self.topology_api_app.routing.installed_paths[key]
             self.topology_api_app.routing.uninstall_path(src, dst, path)
 
@@ -222,8 +681,20 @@ class SDNMgmtController(ControllerBase):
     @route('sdnmgmt', '/v1.0/sdnmgmt/migrate', methods=['POST'])
     def migrate(self, req, **kwargs):
         mac = req.params.get('mac')
+        hypervisor = req.params.get('hypervisor')
 
         if not mac:
             return exc.HTTPBadRequest()
 
-        self.topology_api_app.routing.migrate(mac)
\ No newline at end of file
+        # With the target hypervisor the paths are set up before the VM moves
+        if hypervisor:
+            if not self.topology_api_app.routing.prepare_migration(mac, hypervisor):
+                return exc.HTTPNotFound()
+        else:
+            self.topology_api_app.routing.migrate(mac)
+
+        return Response(content_type='application/json', body='')
+
+    @route('sdnmgmt', '/v1.0/sdnmgmt/migrations', methods=['GET'])
+    def migrations(self, req, **kwargs):
+        return Response(content_type='application/json', body=json.dumps(list(self.topology_api_app.routing.migrations)))
\ No newline at end of file
@@ -0,0 +1,145 @@
+import socket
+import struct
+import time
+
+from ryu.lib import hub
+
+SFLOW_PORT = 6343
+
+# Datagrams read before decoding them together
+BATCH_SIZE = 64
+MAX_DATAGRAM = 65535
+
+# Sample and record formats of the sFlow v5 standard enterprise
+FLOW_SAMPLE = 1
+EXPANDED_FLOW_SAMPLE = 3
+RAW_PACKET_HEADER = 1
+HEADER_PROTOCOL_ETHERNET = 1
+
+HEADER = struct.Struct('!II')
+FLOW_SAMPLE_HEADER = struct.Struct('!IIIIIIII')
+EXPANDED_FLOW_SAMPLE_HEADER = struct.Struct('!IIIIIIIIIII')
+RAW_PACKET_HEADER_HEADER = struct.Struct('!IIII')
+
+def mac_to_str(raw):
+    return ':'.join('{:02x}'.format(ord(b)) for b in raw)
+
+def decode(datagram):
+    """ (agent, src MAC, dst MAC, frame length, sampling rate) of the Ethernet samples of an
+        sFlow v5 datagram, raises struct.error or ValueError if malformed """
+    version, address_type = HEADER.unpack_from(datagram, 0)
+    if version != 5:
+        raise ValueError('sFlow version {} not supported'.format(version))
+
+    # IPv4 or IPv6 agent, then sub agent, sequence number and uptime
+    address_length = 4 if address_type == 1 else 16
+    agent = datagram[8:8+address_length]
+    num_samples, = struct.unpack_from('!I', datagram, 8 + address_length + 12)
+    offset = 8 + address_length + 16
+
+    for _ in range(num_samples):
+        sample_format, sample_length = HEADER.unpack_from(datagram, offset)
+        offset += HEADER.size
+        end = offset + sample_length
+
+        # Counter samples and other enterprises are skipped
+        if sample_format == FLOW_SAMPLE:
+            fields = FLOW_SAMPLE_HEADER.unpack_from(datagram, offset)
+            sampling_rate, num_records = fields[2], fields[7]
+            record = offset + FLOW_SAMPLE_HEADER.size
+        elif sample_format == EXPANDED_FLOW_SAMPLE:
+            fields = EXPANDED_FLOW_SAMPLE_HEADER.unpack_from(datagram, offset)
+            sampling_rate, num_records = fields[3], fields[10]
+            record = offset + EXPANDED_FLOW_SAMPLE_HEADER.size
+        else:
+            num_records = 0
+
+        for _ in range(num_records):
+            record_format, record_length = HEADER.unpack_from(datagram, record)
+            record += HEADER.size
+
+            if record_format == RAW_PACKET_HEADER:
+                protocol, frame_length, _, header_length = RAW_PACKET_HEADER_HEADER.unpack_from(datagram, record)
+                header = record + RAW_PACKET_HEADER_HEADER.size
+                if protocol == HEADER_PROTOCOL_ETHERNET and header_length >= 12:
+                    yield agent, datagram[header+6:header+12], datagram[header:header+6], frame_length, sampling_rate
+
+            record += record_length
+
+        offset = end
+
+class SFlowCollector(object):
+    """ Estimates the traffic rate between MAC pairs from sFlow packet samples. Every sample
+        stands for sampling rate frames of its length, a packet sampled by several switches
+        is averaged over them rather than counted at each """
+    def __init__(self, port=SFLOW_PORT, address='0.0.0.0'):
+        # (src, dst) raw MACs, lowest first -> agent -> estimated bytes
+        self.bytes = {}
+        self.started = time.time()
+
+        self.datagrams = 0
+        self.samples = 0
+        self.errors = 0
+
+        self.sock = None
+        if port is not None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind((address, port))
+            self.thread = hub.spawn(self._loop)
+
+    def _loop(self):
+        while True:
+            batch = [self.sock.recv(MAX_DATAGRAM)]
+
+            # Whatever else already arrived goes in the same batch
+            self.sock.setblocking(False)
+            try:
+                while len(batch) < BATCH_SIZE:
+                    batch.append(self.sock.recv(MAX_DATAGRAM))
+            except socket.error:
+                pass
+            finally:
+                self.sock.setblocking(True)
+
+            self.feed(batch)
+
+    def feed(self, datagrams):
+        estimated = self.bytes
+        for datagram in datagrams:
+            self.datagrams += 1
+            try:
+                samples = list(decode(datagram))
+            except (struct.error, ValueError):
+                self.errors += 1
+                continue
+
+            for agent, src, dst, frame_length, sampling_rate in samples:
+                # Broadcast and multicast don't belong to a pair
+                if ord(dst[0]) & 1:
+                    continue
+
+                key = (src, dst) if src < dst else (dst, src)
+                agents = estimated.setdefault(key, {})
+                agents[agent] = agents.get(agent, 0) + frame_length * sampling_rate
+
+            self.samples += len(samples)
+
+    def rates(self, now):
+        """ Bytes per second of every pair since the previous call and the duration it covers """
+        duration = now - self.started
+        estimated, self.bytes, self.started = self.bytes, {}, now
+        if duration <= 0:
+            return {}, duration
+
+        rates = {}
+        for (mac1, mac2), agents in estimated.items():
+            rates[(mac_to_str(mac1), mac_to_str(mac2))] = sum(agents.values()) / float(len(agents)) / duration
+
+        return rates, duration
+
+    def to_dict(self):
+        return {
+            'datagrams': self.datagrams,
+            'samples':   self.samples,
+            'errors':    self.errors
+        }
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+""" Record sFlow datagrams, replay them to a collector or decode them offline to compare the
+    estimated pair rates and the CPU time with the flow stats polling.
+
+    Recordings are a sequence of (timestamp, length) headers each followed by the datagram """
+
+import argparse
+import json
+import socket
+import struct
+import sys
+import time
+
+from ryu.sdnmgmt.sflow import SFLOW_PORT, MAX_DATAGRAM, BATCH_SIZE, SFlowCollector
+
+RECORD_HEADER = struct.Struct('!dI')
+
+def read_recording(path):
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+
+            timestamp, length = RECORD_HEADER.unpack(header)
+            yield timestamp, f.read(length)
+
+def record(args):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('0.0.0.0', args.port))
+
+    count = 0
+    with open(args.file, 'ab') as f:
+        while not args.count or count < args.count:
+            datagram = sock.recv(MAX_DATAGRAM)
+            f.write(RECORD_HEADER.pack(time.time(), len(datagram)))
+            f.write(datagram)
+            count += 1
+
+    print 'recorded {} datagrams'.format(count)
+
+def replay(args):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    first = None
+    started = time.time()
+    count = 0
+    for timestamp, datagram in read_recording(args.file):
+        if first is None:
+            first = timestamp
+
+        # Keep the recorded spacing, sped up by args.speed
+        delay = (timestamp - first) / args.speed - (time.time() - started)
+        if delay > 0:
+            time.sleep(delay)
+
+        sock.sendto(datagram, (args.host, args.port))
+        count += 1
+
+    print 'replayed {} datagrams in {:.3f}s'.format(count, time.time() - started)
+
+def decode(args):
+    """ One line of JSON per interval of recorded time with the estimated rates """
+    collector = SFlowCollector(port=None)
+    cpu = 0.0
+
+    window = None
+    batch = []
+    for timestamp, datagram in read_recording(args.file):
+        if window is None:
+            window = collector.started = timestamp
+
+        if timestamp - window >= args.interval:
+            start = time.clock()
+            collector.feed(batch)
+            rates, duration = collector.rates(timestamp)
+            cpu += time.clock() - start
+
+            print json.dumps({ 'time': timestamp, 'duration': duration, 'rates': { '{} <> {}'.format(*k): v for k, v in rates.items() } })
+            window = timestamp
+            batch = []
+
+        batch.append(datagram)
+
+        # Same batches as the collector reading the socket
+        if len(batch) >= BATCH_SIZE:
+            start = time.clock()
+            collector.feed(batch)
+            cpu += time.clock() - start
+            batch = []
+
+    start = time.clock()
+    collector.feed(batch)
+    cpu += time.clock() - start
+
+    stats = collector.to_dict()
+    stats['cpu'] = cpu
+    print >> sys.stderr, json.dumps(stats)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers()
+
+    p = subparsers.add_parser('record', help='record the datagrams sent to a port')
+    p.add_argument('file')
+    p.add_argument('--port', type=int, default=SFLOW_PORT)
+    p.add_argument('--count', type=int, default=0, help='stop after count datagrams')
+    p.set_defaults(func=record)
+
+    p = subparsers.add_parser('replay', help='send a recording to a collector')
+    p.add_argument('file')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=SFLOW_PORT)
+    p.add_argument('--speed', type=float, default=1.0)
+    p.set_defaults(func=replay)
+
+    p = subparsers.add_parser('decode', help='estimate the pair rates of a recording')
+    p.add_argument('file')
+    p.add_argument('--interval', type=float, default=1.0, help='seconds of recorded time per estimate')
+    p.set_defaults(func=decode)
+
+    args = parser.parse_args()
+    args.func(args)
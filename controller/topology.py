@@ -0,0 +1,102 @@
+import array
+
+import networkx as nx
+
+class CompactTopology(object):
+    """ Read-only snapshot of the switch fabric with integer node ids and the adjacency in
+        CSR form. Hosts are leaves and left out, they come and go without a rebuild """
+    __slots__ = ('version', 'nodes', 'ids', 'offsets', 'neighbours')
+
+    def __init__(self, graph, version):
+        self.version = version
+
+        self.nodes = [n for n, data in graph.nodes(data=True) if data.get('type') == 'switch']
+        self.ids = { n: i for i, n in enumerate(self.nodes) }
+
+        # Neighbours of node i are neighbours[offsets[i]:offsets[i+1]]
+        self.offsets = array.array('l', [0])
+        self.neighbours = array.array('l')
+
+        for n in self.nodes:
+            for m in graph[n]:
+                if m in self.ids:
+                    self.neighbours.append(self.ids[m])
+            self.offsets.append(len(self.neighbours))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.ids
+
+    def bfs(self, source, target=None):
+        """ BFS parents from source (-1 if unreachable), stops once target is reached """
+        offsets = self.offsets
+        neighbours = self.neighbours
+
+        parents = array.array('l', [-1]) * len(self.nodes)
+        parents[source] = source
+
+        frontier = [source]
+        while frontier and (target is None or parents[target] == -1):
+            next_frontier = []
+            for u in frontier:
+                for k in range(offsets[u], offsets[u+1]):
+                    v = neighbours[k]
+                    if parents[v] == -1:
+                        parents[v] = u
+                        next_frontier.append(v)
+            frontier = next_frontier
+
+        return parents
+
+    def shortest_path(self, src, dst):
+        if src not in self.ids or dst not in self.ids:
+            raise nx.NetworkXNoPath('{} or {} not in the topology'.format(src, dst))
+
+        s = self.ids[src]
+        t = self.ids[dst]
+
+        parents = self.bfs(s, t)
+        if parents[t] == -1:
+            raise nx.NetworkXNoPath('no path between {} and {}'.format(src, dst))
+
+        path = [t]
+        while path[-1] != s:
+            path.append(parents[path[-1]])
+
+        return [self.nodes[i] for i in reversed(path)]
+
+    def distances(self, src):
+        """ Hop count from src to every node id, -1 if unreachable """
+        s = self.ids[src]
+        offsets = self.offsets
+        neighbours = self.neighbours
+
+        distances = array.array('l', [-1]) * len(self.nodes)
+        distances[s] = 0
+
+        frontier = [s]
+        while frontier:
+            next_frontier = []
+            for u in frontier:
+                for k in range(offsets[u], offsets[u+1]):
+                    v = neighbours[k]
+                    if distances[v] == -1:
+                        distances[v] = distances[u] + 1
+                        next_frontier.append(v)
+            frontier = next_frontier
+
+        return distances
+
+    def to_networkx(self):
+        """ Rebuild a networkx graph of the snapshot, for debugging """
+        graph = nx.Graph()
+        for n in self.nodes:
+            graph.add_node(n, type='switch')
+
+        for i, n in enumerate(self.nodes):
+            for k in range(self.offsets[i], self.offsets[i+1]):
+                graph.add_edge(n, self.nodes[self.neighbours[k]])
+
+        return graph
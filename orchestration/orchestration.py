@@ -118,6 +118,10 @@ def calculate_cost_matrix(traffic_matrix, vm_placement, hypervisor_weight_matrix
 				# skipping the vm placement is unknown
 				continue
 
+			# No path between the hypervisors
+			if peer_hypervisor_dpid not in hypervisor_weight_matrix.get(source_hypervisor_dpid, {}):
+				continue
+
 			weight = hypervisor_weight_matrix[source_hypervisor_dpid][peer_hypervisor_dpid]['total_cost']
 			# print "weight from {} to {} is {}".format(source_hypervisor_dpid, peer_hypervisor_dpid, weight)
 
@@ -188,10 +192,12 @@ def cost_calculated(cost_matrix, overall_cost_matrix, total_cost):
 					target_hypervisor = hypervisors_dpid_to_hostname[potential_hypervisor_dpid]
 
 					print '**** Migrating {} to {} ****'.format(vm_name, target_hypervisor)
-					migrate(getallocation(), vm_name, target_hypervisor)
 
-					conn.request("POST", "/v1.0/sdnmgmt/migrate?mac={}".format(vm))
+					# Set up the paths at the target first, the controller switches over when the VM gets there
+					conn.request("POST", "/v1.0/sdnmgmt/migrate?mac={}&hypervisor={}".format(vm, potential_hypervisor_dpid))
 					conn.getresponse().read()
+
+					migrate(getallocation(), vm_name, target_hypervisor)
 				else:
 					print 'Network unstable, relative standard deviation of {}'.format(rsd)
 
@@ -208,8 +214,8 @@ hypervisor_mac_to_dpid = {}
 hypervisor_dpid_to_mac = {}
 hypervisors_ip = ['10.0.0.1','10.0.0.2','10.0.0.3','10.0.0.4', '10.0.0.5','10.0.0.6','10.0.0.7','10.0.0.8']
 while len(hypervisor_mac_to_dpid) < len(hypervisors_ip):
-# Send hypervisor discovery
-	conn.request("GET", "/v1.0/sdnmgmt/discovery?dst={}".format(','.join(hypervisors_ip)))
+# Send hypervisor discovery, returns once they all answered or the probes gave up
+	conn.request("GET", "/v1.0/sdnmgmt/discovery?dst={}&wait=10".format(','.join(hypervisors_ip)))
 	conn.getresponse().read()
 
 	conn.request("GET", "/v1.0/sdnmgmt/hypervisors")
@@ -217,71 +223,69 @@ while len(hypervisor_mac_to_dpid) < len(hypervisors_ip):
 	hypervisor_dpid_to_mac = { v: k for k, v in hypervisor_mac_to_dpid.items() }
 		
 	print '{}/{} hypervisors initialised, waiting ...'.format(len(hypervisor_mac_to_dpid), len(hypervisors_ip))
-	time.sleep(2)
 
 print '{} hypervisors initialised, starting orchestration'.format(len(hypervisor_mac_to_dpid))
 #hack
 hypervisor_dpid_to_mac.pop("0000000000000004", None)
 hypervisor_mac_to_dpid.pop("90:b1:1c:87:72:c5", None)
 
-# Create a hypervisor to hypervisors weight map
-hypervisor_weight_matrix = {}
-for dpid in hypervisor_dpid_to_mac.keys():
-	conn.request("GET", "/v1.0/sdnmgmt/cost?src={}".format(dpid))
-	h2h_costs = response_as_json(conn)
+# Create a hypervisor to hypervisors weight map, weighted by the link utilisations
+def get_cost_matrix(etag=None):
+	conn.request("GET", "/v1.0/sdnmgmt/costmatrix?weighted=1", headers={ 'If-None-Match': etag } if etag else {})
+	resp = conn.getresponse()
+	body = resp.read()
+	if resp.status == 304:
+		return None, etag
+
+	hypervisor_weight_matrix = json.loads(body)['costs']
+	log.write(json.dumps(hypervisor_weight_matrix))
+	log.write('\n')
 
-	for destination, cost in h2h_costs.items():
-		hypervisor_weight_matrix.setdefault(dpid, {})[destination] = cost
+	return hypervisor_weight_matrix, resp.getheader('ETag')
 
-log.write(json.dumps(hypervisor_weight_matrix))
-log.write('\n')
+hypervisor_weight_matrix, cost_matrix_etag = get_cost_matrix()
 
 # Now that all the hypervisors are initiliased, need to trigger a flow stat requests
 last_migration_times = {}
 selected_to_migrate = None
+stats_epoch = 0
+pair_rates = {}
+vm_placement = {}
 while True:
-	conn.request("POST", "/v1.0/sdnmgmt/query")
-	conn.getresponse().read()
-
-	# Wait a bit for the switches to reply (hacky ...)
-	time.sleep(1)
-
-	# Query the current flow stats	
-	conn.request("GET", "/v1.0/sdnmgmt/view")
-	stats = response_as_json(conn)
+	# The controller polls the switches and pushes what changed once a round newer than the last one we saw completes
+	conn.request("GET", "/v1.0/sdnmgmt/subscribe?since={}&wait=10".format(stats_epoch))
+	update = response_as_json(conn)
+	if update['epoch'] == stats_epoch:
+		continue
+
+	stats_epoch = update['epoch']
+	if update['full']:
+		pair_rates = {}
+		vm_placement = {}
+
+	for k, v in update['rates'].items():
+		if v is None:
+			pair_rates.pop(k, None)
+		else:
+			pair_rates[k] = v
 
 	### Get the VM's hypervisors
-	conn.request("GET", "/v1.0/sdnmgmt/placement")
-	vm_placement = response_as_json(conn)
+	vm_placement.update(update['placement'])
+
+	# Not modified most of the time, the utilisations only matter when they change significantly
+	weights, cost_matrix_etag = get_cost_matrix(cost_matrix_etag)
+	if weights is not None:
+		hypervisor_weight_matrix = weights
 
 	### Keep a matrix of the traffic rate
 	traffic_matrix = {}
-	for k, v in stats.items():
-		# For the source and destination of the traffic
-		mac1 = v['endpoints']['mac1']
-		mac2 = v['endpoints']['mac2']
-
-		traffic_rate = v['traffic_rate']
-		if traffic_rate > 0:
-			traffic_matrix.setdefault(mac1, {})[mac2] = traffic_rate
-			traffic_matrix.setdefault(mac2, {})[mac1] = traffic_rate
+	for mac1, mac2, traffic_rate, ewma_rate in pair_rates.values():
+		# Smoothed by the controller, a single burst doesn't trigger a migration
+		if ewma_rate > 0:
+			traffic_matrix.setdefault(mac1, {})[mac2] = ewma_rate
+			traffic_matrix.setdefault(mac2, {})[mac1] = ewma_rate
 	# print traffic_matrix
 
-	### Compute the weight matrix
-	weight_matrix = {}
-	for k, v in stats.items():
-		# Cost can be blank if the path between source and dest in unknown
-		if not v.get('cost'):
-			continue
-
-		# For the source and destination of the traffic
-		mac1 = v['endpoints']['mac1']
-		mac2 = v['endpoints']['mac2']
-
-		cost = v['cost']['total_cost']
-		if cost > 0:
-			weight_matrix.setdefault(mac1, {})[mac2] = cost
-
 	cost_matrix, overall_cost_matrix, total_cost = calculate_cost_matrix(traffic_matrix, vm_placement, hypervisor_weight_matrix)
 
 	log.write(json.dumps(vm_placement))
@@ -294,7 +298,6 @@ while True:
 	# print 'Total cost {}'.format(total_cost)
 	
 	cost_calculated(cost_matrix, overall_cost_matrix, total_cost)
-	time.sleep(4)
 
 
 	# # print cost_matrix